@@ -1,14 +1,505 @@
 import argparse
+import bz2
+import glob
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import math
+from collections import Counter, OrderedDict
 from moz_sql_parser import parse
 from moz_sql_parser.formatting import Formatter
+import multiprocessing
+import os
 import pyparsing
+import random
 import re
+import sqlite3
 import sys
+import time
 import pdb
 
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+READ_BUFFER_SIZE = 1024 * 1024
+COMPRESSED_OPENERS = {
+  '.gz': gzip.open,
+  '.bz2': bz2.open,
+  '.xz': lzma.open,
+}
+DEFAULT_CACHE_SIZE = 100000
+CACHE_WRITE_BATCH_SIZE = 1000
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_FLUSH_AFTER = 5.0
+CHECKPOINT_EVERY_LINES = 10000
+MAX_STATEMENT_CHARS = 100000
+MISSING = object()
+LITERAL_PLACEHOLDER = {'literal': '?'}
+
+QUOTES = ("'", '"', '`')
+# Quotes, parens, statement terminator and markers which start trailing log
+# noise, e.g. Rails bind values ' [[...]]' or a trailing comment
+QUERY_BOUNDARY_RE = re.compile(r"""['"`()]|;|\s\[\[|\s/\*|\s--""")
+STATEMENT_START_RE = re.compile(r'SELECT |WITH \w+ AS \(')
+# Line so far ends mid-statement, or next line continues the statement
+CONTINUATION_END_RE = re.compile(r'(?:[,(=<>+]|\b(?:SELECT|DISTINCT|FROM|WHERE|AND|OR|NOT|ON|BY|JOIN|AS|WITH|UNION|ALL|IN|INTERSECT|EXCEPT|HAVING))\s*$')
+CONTINUATION_START_RE = re.compile(r'\s*(?:[),]|(?:FROM|WHERE|AND|OR|JOIN|INNER|LEFT|RIGHT|FULL|CROSS|NATURAL|ON|GROUP|ORDER|HAVING|LIMIT|OFFSET|UNION|INTERSECT|EXCEPT)\b)')
+
+def scan_query(text, depth=0, quote=None):
+  """
+  Scan text of a SQL statement, starting with given paren depth and open
+  quote. Return (end, depth, quote) where end is the index of the first ';',
+  unbalanced ')' or trailing log marker outside quotes and parens, or None if
+  the statement does not end in text.
+  """
+  for match in QUERY_BOUNDARY_RE.finditer(text):
+    token = match.group()
+    if quote:
+      if token == quote:
+        quote = None
+      continue
+
+    if token in QUOTES:
+      quote = token
+    elif token == '(':
+      depth += 1
+    elif token == ')':
+      if depth == 0:
+        return match.start(), depth, quote
+      depth -= 1
+    elif depth == 0:
+      return match.start(), depth, quote
+
+  return None, depth, quote
+
+def find_query_end(text):
+  """
+  Return index where the SQL statement at the start of text likely ends.
+  The end is the first ';', unbalanced ')' or trailing log marker outside
+  quotes and parens, or the end of text.
+  """
+  end, _, _ = scan_query(text)
+  return len(text) if end is None else end
+
+class StatementAssembler:
+  """
+  Assembles SQL statements from log lines. A statement starts at 'SELECT ' or
+  a 'WITH name AS (' CTE and continues on following lines while parens or
+  quotes are open, the line so far ends mid-clause (e.g. with ',' or 'AND'),
+  or the next line starts with a clause keyword such as FROM or WHERE. A line
+  with log text before a statement start begins a new log record, even if a
+  quote is open. A statement whose quote is still open when it ends was cut
+  off in the log, so the lines carried only by that quote are dropped.
+  Several statements on one line are split on ';'. Statements longer than
+  max_chars are dropped and counted in stats['oversized']. After feed(),
+  start is the index in the line where the pending statement began, or None
+  if it began on an earlier line.
+  """
+  def __init__(self, max_chars=MAX_STATEMENT_CHARS, stats=None):
+    self.max_chars = max_chars
+    self.stats = stats if stats is not None else Counter()
+    self.parts = []
+    # index in parts of the first line continued only because a quote was open
+    self.quote_carry = None
+    self.start = None
+    self.size = 0
+    self.depth = 0
+    self.quote = None
+
+  def feed(self, line, start_new=True):
+    """
+    Add log line (str, or bytes which are decoded only if needed), return list
+    of statements it completed. With start_new False, the line may only
+    continue the pending statement and no new statement is started from it.
+    """
+    statements = []
+    self.start = None
+    if isinstance(line, bytes):
+      if not self.parts and not (start_new and (b'SELECT ' in line or b'WITH ' in line)):
+        return statements
+      line = line.decode('utf-8', errors='replace')
+    line = line.rstrip('\r\n')
+
+    text = None
+    if self.parts:
+      if self.depth or self._continues(line):
+        text = line
+      elif self.quote and not self._starts_record(line):
+        if self.quote_carry is None:
+          self.quote_carry = len(self.parts)
+        text = line
+      else:
+        statements.extend(self.flush())
+
+    if text is None:
+      match = STATEMENT_START_RE.search(line) if start_new else None
+      if not match:
+        return statements
+      self.start = match.start()
+      text = line[self.start:]
+
+    while True:
+      end, self.depth, self.quote = scan_query(text, self.depth, self.quote)
+      if end is None:
+        self._append(text)
+        if not self.quote:
+          self.quote_carry = None
+        return statements
+
+      self._append(text[:end])
+      statements.extend(self.flush())
+      match = STATEMENT_START_RE.search(text, end + 1) if start_new else None
+      if not match:
+        return statements
+      self.start = len(line) - len(text) + match.start()
+      text = text[match.start():]
+
+  def flush(self):
+    """
+    Return pending statement, if any, as a list
+    """
+    if self.quote and self.quote_carry is not None:
+      self.parts = self.parts[:self.quote_carry]
+    statement = '\n'.join(self.parts).strip()
+    self.parts = []
+    self.quote_carry = None
+    self.size = 0
+    self.depth = 0
+    self.quote = None
+    return [statement] if statement else []
+
+  def is_complete(self):
+    """
+    Whether a pending statement exists and would be complete unless the next
+    line starts with a clause keyword
+    """
+    return bool(self.parts) and not self.depth and not self.quote and CONTINUATION_END_RE.search(self.parts[-1]) is None
+
+  def _continues(self, line):
+    if CONTINUATION_START_RE.match(line):
+      return True
+    if CONTINUATION_END_RE.search(self.parts[-1]) is None:
+      return False
+    return not self._starts_record(line)
+
+  def _starts_record(self, line):
+    # A line with log text before a statement start is a new log record
+    match = STATEMENT_START_RE.search(line)
+    return match is not None and bool(line[:match.start()].strip(' \t('))
+
+  def _append(self, text):
+    self.parts.append(text)
+    self.size += len(text)
+    if self.size > self.max_chars:
+      self.stats['oversized'] += 1
+      self.flush()
+
+def is_compressed(file_path):
+  return os.path.splitext(file_path)[1] in (*COMPRESSED_OPENERS, '.zst')
+
+def open_log(file_path):
+  """
+  Open log file for buffered binary reading, decompressing .gz, .bz2, .xz and
+  .zst (needs the zstandard package) files on the fly
+  """
+  extension = os.path.splitext(file_path)[1]
+  if extension in COMPRESSED_OPENERS:
+    return io.BufferedReader(COMPRESSED_OPENERS[extension](file_path, 'rb'), READ_BUFFER_SIZE)
+  if extension == '.zst':
+    if zstandard is None:
+      raise Exception(f"Reading {file_path} needs the zstandard package: pip install zstandard")
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True), READ_BUFFER_SIZE)
+  return open(file_path, 'rb', buffering=READ_BUFFER_SIZE)
+
+def expand_log_paths(paths):
+  """
+  Expand directories and glob patterns into log file paths. Files of each
+  directory or pattern are ordered oldest first, so a rotation set such as
+  app.log.2.gz, app.log.1.gz, app.log is read in time order.
+  """
+  if isinstance(paths, str):
+    paths = [paths]
+
+  file_paths = []
+  for path in paths:
+    if os.path.isdir(path):
+      matches = [os.path.join(path, name) for name in os.listdir(path)]
+    elif glob.has_magic(path):
+      matches = glob.glob(path)
+    else:
+      file_paths.append(path)
+      continue
+    matches = [match for match in matches if os.path.isfile(match)]
+    file_paths.extend(sorted(matches, key=lambda match: (os.path.getmtime(match), match)))
+  return file_paths
+
+def load_checkpoint(checkpoint_file):
+  """
+  Return (inode, offset) saved by save_checkpoint(), or (None, 0)
+  """
+  if not checkpoint_file or not os.path.exists(checkpoint_file):
+    return None, 0
+  with open(checkpoint_file) as f:
+    checkpoint = json.load(f)
+  return checkpoint['inode'], checkpoint['offset']
+
+def byte_index(line, index):
+  """
+  Byte offset in line of char index in line decoded as utf-8, or 0 if
+  invalid utf-8 before index makes it unknown
+  """
+  prefix = line.decode('utf-8', errors='replace')[:index].encode('utf-8')
+  return len(prefix) if line.startswith(prefix) else 0
+
+def save_checkpoint(checkpoint_file, inode, offset):
+  if not checkpoint_file:
+    return
+  temp_file = checkpoint_file + '.tmp'
+  with open(temp_file, 'w') as f:
+    json.dump({'inode': inode, 'offset': offset}, f)
+  os.replace(temp_file, checkpoint_file)
+
+def format_query(ast):
+  """
+  Format moz_sql_parser AST as SQL. Formatter().format() leaves out WITH
+  clauses, so CTEs are formatted here.
+  """
+  ctes = ast.get('with') if isinstance(ast, dict) else None
+  if not ctes:
+    return Formatter().format(ast)
+
+  if isinstance(ctes, dict):
+    ctes = [ctes]
+  body = {key: value for key, value in ast.items() if key != 'with'}
+  with_clause = ', '.join(f"{cte['name']} AS ({Formatter().format(cte['value'])})" for cte in ctes)
+  return f"WITH {with_clause} {Formatter().format(body)}"
+
+def normalize_ast(node):
+  """
+  Replace literals in moz_sql_parser AST with a placeholder. Lists made only
+  of literals, e.g. IN (1, 2, 3), collapse to a single placeholder.
+  """
+  if isinstance(node, dict):
+    if 'literal' in node:
+      return LITERAL_PLACEHOLDER
+    return {key: normalize_ast(value) for key, value in node.items()}
+  if isinstance(node, list):
+    values = [normalize_ast(value) for value in node]
+    if values and all(value is LITERAL_PLACEHOLDER for value in values):
+      return LITERAL_PLACEHOLDER
+    return values
+  if isinstance(node, (int, float)) and not isinstance(node, bool):
+    return LITERAL_PLACEHOLDER
+  return node
+
+def fingerprint_ast(ast):
+  """
+  64-bit hex digest of literal-normalized AST. Queries differing only by
+  literal values have the same fingerprint.
+  """
+  normalized = json.dumps(normalize_ast(ast), sort_keys=True, separators=(',', ':'))
+  return hashlib.blake2b(normalized.encode('utf-8'), digest_size=8).hexdigest()
+
+class BloomFilter:
+  """
+  Fixed size set of fingerprints with false positive rate error_rate once
+  capacity fingerprints are added
+  """
+  def __init__(self, capacity, error_rate=0.001):
+    self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+    self.bits = bytearray((self.size + 7) // 8)
+
+  def _positions(self, fingerprint):
+    value = int(fingerprint, 16)
+    h1, h2 = value & 0xffffffff, (value >> 32) | 1
+    return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+  def add(self, fingerprint):
+    """
+    Add fingerprint, return True if it was (probably) not in the filter before
+    """
+    is_new = False
+    for position in self._positions(fingerprint):
+      byte, bit = divmod(position, 8)
+      if not self.bits[byte] & (1 << bit):
+        self.bits[byte] |= 1 << bit
+        is_new = True
+    return is_new
+
+class QueryDeduplicator:
+  """
+  Streaming dedup of (query, fingerprint) pairs, yielding the first query of
+  each shape. Exact mode keeps a count and first query per fingerprint.
+  With bloom_capacity, only a Bloom filter is kept so memory is bounded, and
+  occurrence counts are not available.
+  """
+  def __init__(self, bloom_capacity=None, bloom_error_rate=0.001):
+    self.bloom = BloomFilter(bloom_capacity, bloom_error_rate) if bloom_capacity else None
+    self.shapes = {} # fingerprint -> [count, first query]
+    self.total = 0
+
+  def add(self, query, fingerprint):
+    """
+    Return True if this is the first query seen with given fingerprint
+    """
+    self.total += 1
+    if self.bloom:
+      return self.bloom.add(fingerprint)
+
+    shape = self.shapes.get(fingerprint)
+    if shape:
+      shape[0] += 1
+      return False
+    self.shapes[fingerprint] = [1, query]
+    return True
+
+  def dedup(self, fingerprinted_queries):
+    for query, fingerprint in fingerprinted_queries:
+      if self.add(query, fingerprint):
+        yield query
+
+  def counts(self):
+    """
+    (count, query) for each shape, most frequent first
+    """
+    return sorted((tuple(shape) for shape in self.shapes.values()), key=lambda shape: -shape[0])
+
+class QueryCache:
+  """
+  Bounded LRU cache of query text -> (formatted query, fingerprint, None), or
+  (None, None, (error category, position, text parsed)) if parsing failed,
+  optionally backed by a sqlite file which persists across runs.
+  New entries are written to the file in batches, each in one short
+  transaction, so parallel workers sharing the file don't hold its write
+  lock while they parse.
+  """
+  def __init__(self, max_size=DEFAULT_CACHE_SIZE, db_path=None, stats=None):
+    self.max_size = max_size
+    self.entries = OrderedDict()
+    self.stats = stats if stats is not None else Counter()
+    self.pending = {}
+    self.db = None
+    if db_path:
+      self.db = sqlite3.connect(db_path, timeout=60)
+      self.db.execute("CREATE TABLE IF NOT EXISTS queries (text TEXT PRIMARY KEY, query TEXT, fingerprint TEXT, error TEXT)")
+      if 'error' not in {column[1] for column in self.db.execute("PRAGMA table_info(queries)")}:
+        # cache file written before failures kept their error
+        self.db.execute("ALTER TABLE queries ADD COLUMN error TEXT")
+
+  def get(self, text):
+    query = self.entries.get(text, MISSING)
+    if query is not MISSING:
+      self.entries.move_to_end(text)
+      self.stats['cache_hits'] += 1
+      return query
+
+    if self.db:
+      entry = self.pending.get(text) or self._load(text)
+      if entry:
+        self.stats['cache_store_hits'] += 1
+        self._remember(text, entry)
+        return entry
+
+    self.stats['cache_misses'] += 1
+    return MISSING
+
+  def put(self, text, entry):
+    self._remember(text, entry)
+    if self.db:
+      self.pending[text] = entry
+      if len(self.pending) >= CACHE_WRITE_BATCH_SIZE:
+        self.flush()
+
+  def _load(self, text):
+    row = self.db.execute("SELECT query, fingerprint, error FROM queries WHERE text = ?", (text,)).fetchone()
+    if row is None:
+      return None
+    query, fingerprint, error = row
+    if query is None and error is None:
+      # failure stored without its error, parse again to report it
+      return None
+    return query, fingerprint, tuple(json.loads(error)) if error else None
+
+  def _remember(self, text, entry):
+    if self.max_size <= 0:
+      return
+    self.entries[text] = entry
+    if len(self.entries) > self.max_size:
+      self.entries.popitem(last=False)
+      self.stats['cache_evictions'] += 1
+
+  def flush(self):
+    if self.db and self.pending:
+      with self.db:
+        self.db.executemany("INSERT OR REPLACE INTO queries (text, query, fingerprint, error) VALUES (?, ?, ?, ?)",
+                            ((text, query, fingerprint, json.dumps(error) if error else None)
+                             for text, (query, fingerprint, error) in self.pending.items()))
+      self.pending = {}
+
+  def close(self):
+    if self.db:
+      self.flush()
+      self.db.close()
+      self.db = None
+
+class ErrorReporter:
+  """
+  Collects query parse failures. Failures are counted by (category,
+  position), where category is the pyparsing error message and position the
+  char index it failed at. A sample_rate fraction of failures is written to
+  error_file as JSON lines with text, category and position.
+  """
+  def __init__(self, error_file=None, sample_rate=1.0):
+    self.groups = Counter()
+    self.sample_rate = sample_rate
+    self.random = random.Random(0)
+    # line buffered, so parallel workers appending to the same file write whole lines
+    self.file = open(error_file, 'a', buffering=1) if error_file else None
+
+  def report(self, category, position, text):
+    self.groups[(category, position)] += 1
+    if self.file and (self.sample_rate >= 1.0 or self.random.random() < self.sample_rate):
+      self.file.write(json.dumps({'text': text, 'category': category, 'position': position}) + '\n')
+
+  def most_common(self, n=None):
+    return self.groups.most_common(n)
+
+  def close(self):
+    if self.file:
+      self.file.close()
+      self.file = None
+
 class LogParser:
-  def print_error(self, e, text):
-    print(e, file=sys.stderr)
+  def __init__(self, cache_size=DEFAULT_CACHE_SIZE, cache_file=None, error_file=None, error_sample_rate=1.0, verbose=False):
+    # Passed on to parsers created in worker processes
+    self.options = {'cache_size': cache_size, 'cache_file': cache_file, 'error_file': error_file, 'error_sample_rate': error_sample_rate, 'verbose': verbose}
+    # Print error banner to stderr for every failure
+    self.verbose = verbose
+    self.errors = ErrorReporter(error_file, error_sample_rate)
+    # 'parsed' - query texts parsed, 'fallback' - texts which needed the
+    # error/retry path because the query end was not found up front,
+    # 'cache_*' - QueryCache hits, misses and evictions, 'errors' - failures
+    self.stats = Counter()
+    self.cache = QueryCache(cache_size, cache_file, self.stats)
+
+  def close(self):
+    self.cache.close()
+    self.errors.close()
+
+  def report_error(self, category, position, text):
+    self.stats['errors'] += 1
+    self.errors.report(category, position, text)
+    if self.verbose:
+      self.print_error(category, position, text)
+
+  def print_error(self, category, position, text):
+    print(f"{category} (at char {position})", file=sys.stderr)
     print(file=sys.stderr)
     print("Error parsing query -- ", file=sys.stderr)
     r = int(len(text)/10) + 1
@@ -17,48 +508,319 @@ class LogParser:
     print(f"[{text}]", file=sys.stderr)
     print('-----------------------------', file=sys.stderr)
 
-  def parse_query(self, text):
+  def parse_query(self, text, fingerprint=False):
+    """
+    Return formatted query, or (formatted query, fingerprint) if fingerprint
+    is True. None if text could not be parsed. Failures are reported each
+    time, also when the failure is cached.
+    """
     text = text.strip()
+    entry = self.cache.get(text)
+    if entry is MISSING:
+      try:
+        ast = self.parse_ast(text)
+        entry = (format_query(ast), fingerprint_ast(ast), None) if ast else (None, None, None)
+      except pyparsing.ParseException as e:
+        entry = (None, None, (e.msg, e.loc, e.pstr))
+      except Exception as e:
+        # moz_sql_parser also raises e.g. SyntaxError on malformed literals
+        entry = (None, None, (f"{type(e).__name__}: {e}", None, text))
+      self.cache.put(text, entry)
+
+    query, query_fingerprint, error = entry
+    if query is None:
+      if error:
+        self.report_error(*error)
+      return None
+    return (query, query_fingerprint) if fingerprint else query
+
+  def parse_ast(self, text):
+    """
+    Parse SQL statement at the start of text, raising
+    pyparsing.ParseException if it can't be parsed
+    """
+    text = text[:find_query_end(text)].strip()
+    self.stats['parsed'] += 1
 
-    # We don't know where the query ends in given text string
+    # find_query_end() may still leave trailing text which is not SQL
     # So, if parser throws pyparsing.ParseException, we will look at the
     # char index where it errored. Then we will trim string after that point
     # and try again
     try:
-      ast = parse(text)
+      return parse(text)
     except pyparsing.ParseException as e:
+      self.stats['fallback'] += 1
       error_message = str(e)
       result = re.search(" col\:(\d+)\)", error_message)
       if result:
         char_index = int(result.group(1))
         text = text[:char_index-1].strip()
       else:
-        self.print_error(e, text)
-        return None
+        raise
 
+    return parse(text)
+
+  def extract_queries(self, file_path, fingerprint=False):
+    """
+    Yield queries from log file(s), or (query, fingerprint) if fingerprint is
+    True. file_path may also be a directory, glob pattern or list of those,
+    and files may be compressed.
+    """
+    for path in expand_log_paths(file_path):
+      with open_log(path) as f:
+        yield from self.extract_queries_from_lines(f, fingerprint)
+
+  def extract_queries_from_lines(self, lines, fingerprint=False):
+    """
+    Yield queries from log lines, assembling statements which span lines
+    and splitting lines with several statements
+    """
+    assembler = StatementAssembler(stats=self.stats)
+    for line in lines:
+      yield from self._parse_statements(assembler.feed(line), fingerprint)
+    yield from self._parse_statements(assembler.flush(), fingerprint)
+
+  def _parse_statements(self, statements, fingerprint):
+    for statement in statements:
+      query = self.parse_query(statement, fingerprint)
+      if query:
+        yield query
+
+  def follow_queries(self, file_path, checkpoint_file=None, poll_interval=DEFAULT_POLL_INTERVAL, idle_timeout=None, fingerprint=False,
+                     flush_after=DEFAULT_FLUSH_AFTER):
+    """
+    Yield queries from a live log file like tail -F. Rotation (the path now
+    points to a new file) and truncation restart reading from the top of the
+    file. The byte offset of the last complete line read, or where a
+    statement still pending began, is saved to checkpoint_file, and a restart
+    with the same checkpoint_file resumes there.
+    A statement is pending until a line shows it ended. If it looks complete
+    and no line is written for flush_after seconds, it is yielded without
+    waiting further; None waits for the next line.
+    Stops after idle_timeout seconds without new lines, or never if None.
+    """
+    saved_inode, offset = load_checkpoint(checkpoint_file)
+    assembler = StatementAssembler(stats=self.stats)
+    # offset of the pending statement, which is read again after a restart
+    statement_offset = None
+    checkpoint_offset = lambda: offset if statement_offset is None else statement_offset
+    f = None
+    inode = None
+    lines_since_checkpoint = 0
+    idle_since = time.monotonic()
     try:
-      ast = parse(text)
-    except pyparsing.ParseException as e:
-      self.print_error(e, text)
-      return None
+      while True:
+        if f is None:
+          try:
+            f = open(file_path, 'rb', buffering=READ_BUFFER_SIZE)
+          except FileNotFoundError:
+            f = None
+          if f:
+            inode = os.fstat(f.fileno()).st_ino
+            if inode != saved_inode or offset > os.fstat(f.fileno()).st_size:
+              offset = 0
+            saved_inode = inode
+            f.seek(offset)
+
+        line = f.readline() if f else b''
+        if line.endswith(b'\n'):
+          idle_since = time.monotonic()
+          statements = assembler.feed(line)
+          if not assembler.parts:
+            statement_offset = None
+          elif assembler.start is not None:
+            statement_offset = offset + byte_index(line, assembler.start)
+          offset += len(line)
+          yield from self._parse_statements(statements, fingerprint)
+          lines_since_checkpoint += 1
+          if lines_since_checkpoint >= CHECKPOINT_EVERY_LINES:
+            save_checkpoint(checkpoint_file, inode, checkpoint_offset())
+            lines_since_checkpoint = 0
+          continue
+
+        # At end of file, or a partial line which is still being written
+        if f:
+          f.seek(offset)
+          if flush_after is not None and assembler.is_complete() and time.monotonic() - idle_since >= flush_after:
+            # the writer has paused long enough that no continuation line is expected
+            statement_offset = None
+            yield from self._parse_statements(assembler.flush(), fingerprint)
+          save_checkpoint(checkpoint_file, inode, checkpoint_offset())
+          lines_since_checkpoint = 0
+          try:
+            stat = os.stat(file_path)
+          except FileNotFoundError:
+            stat = None
+          if stat is not None and stat.st_ino != inode:
+            # rotated, the old file has been read to its end
+            statement_offset = None
+            yield from self._parse_statements(assembler.feed(line) + assembler.flush(), fingerprint)
+            f.close()
+            f = None
+            saved_inode, offset = None, 0
+            continue
+          if stat is not None and stat.st_size < offset:
+            # truncated
+            statement_offset = None
+            assembler.flush()
+            offset = 0
+            f.seek(0)
+            continue
+
+        if idle_timeout is not None and time.monotonic() - idle_since >= idle_timeout:
+          return
+        time.sleep(poll_interval)
+    finally:
+      if f:
+        f.close()
+        save_checkpoint(checkpoint_file, inode, checkpoint_offset())
+
+  def extract_unique_queries(self, file_path, deduplicator=None):
+    """
+    Yield first query of each literal-normalized shape in log file.
+    Pass a QueryDeduplicator to share it across files or read its counts.
+    """
+    if deduplicator is None:
+      deduplicator = QueryDeduplicator()
+    yield from deduplicator.dedup(self.extract_queries(file_path, fingerprint=True))
 
-    query = Formatter().format(ast)
-    return query
+  def extract_queries_from_chunk(self, file_path, start, end, fingerprint=False):
+    """
+    Extract queries from statements starting within byte range [start, end) of
+    file. start must be at a line boundary. A statement still open at end is
+    completed from the lines after it. end None reads to the end of file,
+    which is how compressed files are read.
+    """
+    assembler = StatementAssembler()
+    statements = []
+    with open_log(file_path) as f:
+      carried = None
+      if start:
+        # Replay the lines before start, so that a statement still open at
+        # start is recognised and left to the previous chunk
+        f.seek(max(0, start - MAX_STATEMENT_CHARS))
+        if f.tell():
+          f.readline()
+        while f.tell() < start:
+          assembler.feed(f.readline())
+        carried = assembler.parts or None
+        assembler.stats.clear()
 
-  def extract_queries(self, file_path):
-    with open(file_path, 'r') as f:
-      for line in f:
-        index = line.find('SELECT ')
-        if index > -1:
-          text = line[index:]
-          if text:
-            query = self.parse_query(text)
-            if query:
-              yield query
+      position = start
+      while end is None or position < end or assembler.parts:
+        line = f.readline()
+        if not line:
+          break
+        oversized = assembler.stats['oversized']
+        completed = assembler.feed(line, start_new=end is None or position < end)
+        if carried is not None and assembler.parts is not carried:
+          if assembler.stats['oversized'] == oversized:
+            completed = completed[1:]
+          carried = None
+        statements.extend(completed)
+        position += len(line)
+
+    if carried is None:
+      statements.extend(assembler.flush())
+    self.stats.update(assembler.stats)
+    return list(self._parse_statements(statements, fingerprint))
+
+  def extract_queries_parallel(self, paths, workers=None, ordered=True, chunk_size=DEFAULT_CHUNK_SIZE, fingerprint=False):
+    """
+    Extract queries from given log files using a pool of worker processes.
+    Files are split into byte-range chunks on line boundaries. Queries are
+    yielded in file order, or as chunks complete if ordered is False.
+    """
+    chunks = [(*chunk, fingerprint) for path in expand_log_paths(paths) for chunk in split_file(path, chunk_size)]
+    if not chunks:
+      return
+
+    with multiprocessing.Pool(processes=workers, initializer=_init_worker, initargs=(self.__class__, self.options)) as pool:
+      map_chunks = pool.imap if ordered else pool.imap_unordered
+      for queries, stats, error_groups in map_chunks(_extract_chunk, chunks):
+        self.stats.update(stats)
+        self.errors.groups.update(error_groups)
+        yield from queries
+
+def split_file(file_path, chunk_size=DEFAULT_CHUNK_SIZE):
+  """
+  Split file into (file_path, start, end) byte ranges of about chunk_size bytes,
+  with every range starting at a line boundary. Compressed files can't be
+  split and are a single (file_path, 0, None) range.
+  """
+  if is_compressed(file_path):
+    return [(file_path, 0, None)]
+
+  file_size = os.path.getsize(file_path)
+  chunks = []
+  with open(file_path, 'rb') as f:
+    start = 0
+    while start < file_size:
+      f.seek(min(start + chunk_size, file_size))
+      f.readline()
+      end = min(f.tell(), file_size)
+      chunks.append((file_path, start, end))
+      start = end
+  return chunks
+
+_worker_parser = None
+
+def _init_worker(parser_class, options):
+  global _worker_parser
+  _worker_parser = parser_class(**options)
+
+def _extract_chunk(chunk):
+  _worker_parser.stats.clear()
+  _worker_parser.errors.groups.clear()
+  queries = _worker_parser.extract_queries_from_chunk(*chunk)
+  _worker_parser.cache.flush()
+  return queries, _worker_parser.stats, _worker_parser.errors.groups
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
-  parser.add_argument('--log_file', '-f', dest='log_file_path', type=str, required=True, help='Path of log file to parse SQL queried from')
+  parser.add_argument('--log_file', '-f', dest='log_file_paths', type=str, nargs='+', required=True, help='Path(s) of log file(s), directories or glob patterns to parse SQL queried from; .gz, .bz2, .xz and .zst files are decompressed on the fly')
+  parser.add_argument('--workers', '-w', dest='workers', type=int, default=1, help='Number of worker processes; default=1 parses in this process')
+  parser.add_argument('--cache-size', dest='cache_size', type=int, default=DEFAULT_CACHE_SIZE, help=f'Number of distinct query texts to keep parsed in memory; default={DEFAULT_CACHE_SIZE}')
+  parser.add_argument('--cache-file', dest='cache_file', type=str, default=None, help='SQLite file to persist parsed queries across runs')
+  parser.add_argument('--stats', action='store_true', dest='stats', default=False, help='Print parse statistics and most common parse errors to stderr when done')
+  parser.add_argument('--error-file', dest='error_file', type=str, default=None, help='JSONL file to append queries which failed to parse to')
+  parser.add_argument('--error-sample-rate', dest='error_sample_rate', type=float, default=1.0, help='Fraction of failures to write to --error-file; default=1.0')
+  parser.add_argument('--verbose', '-v', action='store_true', dest='verbose', default=False, help='Print every parse error to stderr')
+  parser.add_argument('--follow', action='store_true', dest='follow', default=False, help='Keep reading the log file as it grows, like tail -F, following rotation and truncation')
+  parser.add_argument('--checkpoint-file', dest='checkpoint_file', type=str, default=None, help='With --follow, file to save the read offset to and resume from on restart')
+  parser.add_argument('--poll-interval', dest='poll_interval', type=float, default=DEFAULT_POLL_INTERVAL, help=f'With --follow, seconds to wait for new lines; default={DEFAULT_POLL_INTERVAL}')
+  parser.add_argument('--flush-after', dest='flush_after', type=float, default=DEFAULT_FLUSH_AFTER, help=f'With --follow, seconds without new lines after which a statement which looks complete is output; default={DEFAULT_FLUSH_AFTER}')
+  parser.add_argument('--dedup', action='store_true', dest='dedup', default=False, help='Output only the first query of each shape, ignoring literal values')
+  parser.add_argument('--dedup-bloom-capacity', dest='dedup_bloom_capacity', type=int, default=None, help='With --dedup, track shapes in a Bloom filter sized for this many shapes instead of an exact set')
+  parser.add_argument('--dedup-counts', dest='dedup_counts_file', type=str, default=None, help='With --dedup, write "count<TAB>query" per shape to this file when done')
+  parser.add_argument('--unordered', action='store_true', dest='unordered', default=False, help='With --workers, output queries as chunks complete instead of in file order')
 
   args = parser.parse_args()
-  [print(query) for query in LogParser().extract_queries(args.log_file_path)]
+  log_parser = LogParser(cache_size=args.cache_size, cache_file=args.cache_file, error_file=args.error_file, error_sample_rate=args.error_sample_rate, verbose=args.verbose)
+  if args.follow:
+    if len(args.log_file_paths) != 1:
+      parser.error('--follow takes a single log file')
+    queries = log_parser.follow_queries(args.log_file_paths[0], args.checkpoint_file, args.poll_interval, fingerprint=args.dedup,
+                                        flush_after=args.flush_after)
+  elif args.workers > 1:
+    queries = log_parser.extract_queries_parallel(args.log_file_paths, workers=args.workers, ordered=not args.unordered, fingerprint=args.dedup)
+  else:
+    queries = log_parser.extract_queries(args.log_file_paths, fingerprint=args.dedup)
+
+  if args.dedup:
+    deduplicator = QueryDeduplicator(args.dedup_bloom_capacity)
+    queries = deduplicator.dedup(queries)
+  try:
+    for query in queries:
+      print(query, flush=args.follow)
+  finally:
+    # --follow runs until interrupted, so counts and the cache are still written on Ctrl-C
+    if args.dedup and args.dedup_counts_file:
+      with open(args.dedup_counts_file, 'w') as f:
+        for count, query in deduplicator.counts():
+          f.write(f"{count}\t{query}\n")
+    log_parser.close()
+  if args.stats:
+    print(dict(log_parser.stats), file=sys.stderr)
+    for (category, position), count in log_parser.errors.most_common(10):
+      print(f"{count:8d}  at char {position}: {category}", file=sys.stderr)
@@ -1,5 +1,12 @@
+import bz2
+import gzip
+import json
+import lzma
+import os
 import pytest
-from ..log_parser import LogParser
+import threading
+import time
+from ..log_parser import LogParser, QueryCache, QueryDeduplicator, StatementAssembler, find_query_end, split_file
 
 def test_class_exists():
   assert LogParser
@@ -9,4 +16,242 @@ def test_single_line_queries():
   queries = list(LogParser().extract_queries('tests/fixtures/single_line_queries.log'))
   assert len(queries) == 2
   assert queries[0] == 'SELECT id, name FROM geography_postal_codes WHERE state_ids IS NOT NULL ORDER BY space_count DESC'
-  assert queries[1] == "SELECT * FROM geometry_columns WHERE f_table_name = 'geography_neighborhoods'"
\ No newline at end of file
+  assert queries[1] == "SELECT * FROM geometry_columns WHERE f_table_name = 'geography_neighborhoods'"
+def test_parallel_queries_match_serial():
+  path = 'tests/fixtures/single_line_queries.log'
+  serial = list(LogParser().extract_queries(path))
+  parallel = list(LogParser().extract_queries_parallel(path, workers=2, chunk_size=64))
+  assert parallel == serial
+  unordered = list(LogParser().extract_queries_parallel(path, workers=2, chunk_size=64, ordered=False))
+  assert sorted(unordered) == sorted(serial)
+
+def test_split_file_on_line_boundaries():
+  path = 'tests/fixtures/single_line_queries.log'
+  chunks = split_file(path, 100)
+  with open(path, 'rb') as f:
+    data = f.read()
+  assert chunks[0][1] == 0 and chunks[-1][2] == len(data)
+  for (_, start, end), (_, next_start, _) in zip(chunks, chunks[1:]):
+    assert end == next_start
+    assert data[end-1:end] == b'\n'
+
+def test_find_query_end():
+  assert find_query_end("SELECT a FROM b") == len("SELECT a FROM b")
+  assert find_query_end("SELECT a FROM b; duration 3ms") == len("SELECT a FROM b")
+  assert find_query_end("SELECT a FROM b WHERE c = 'x;y' [[\"c\", \"x;y\"]]") == len("SELECT a FROM b WHERE c = 'x;y'")
+  assert find_query_end("SELECT a FROM (SELECT a FROM b) AS s) trailing") == len("SELECT a FROM (SELECT a FROM b) AS s")
+  assert find_query_end("SELECT a FROM b /* controller:users */") == len("SELECT a FROM b")
+
+def test_trailing_noise_parsed_without_fallback():
+  parser = LogParser()
+  queries = list(parser.extract_queries('tests/fixtures/single_line_queries.log'))
+  assert len(queries) == 2
+  assert parser.stats['parsed'] == 2
+  assert parser.stats['fallback'] == 0
+
+def test_query_cache_hits_and_evictions():
+  parser = LogParser(cache_size=1)
+  text = 'SELECT a FROM b'
+  assert parser.parse_query(text) == parser.parse_query(' ' + text + ' ')
+  assert parser.stats['parsed'] == 1
+  assert parser.stats['cache_hits'] == 1
+  parser.parse_query('SELECT c FROM d')
+  assert parser.stats['cache_evictions'] == 1
+
+def test_query_cache_file_reused_across_runs(tmp_path):
+  cache_file = str(tmp_path / 'queries.sqlite')
+  parser = LogParser(cache_file=cache_file)
+  queries = list(parser.extract_queries('tests/fixtures/single_line_queries.log'))
+  parser.close()
+
+  parser = LogParser(cache_file=cache_file)
+  assert list(parser.extract_queries('tests/fixtures/single_line_queries.log')) == queries
+  assert parser.stats['parsed'] == 0
+  assert parser.stats['cache_store_hits'] == 2
+  parser.close()
+
+def test_query_cache_file_shared_by_workers(tmp_path):
+  # a worker's unwritten entries must not lock the file for the others
+  cache_file = str(tmp_path / 'queries.sqlite')
+  first, second = QueryCache(db_path=cache_file), QueryCache(db_path=cache_file)
+  first.db.execute("PRAGMA busy_timeout = 100")
+  second.db.execute("PRAGMA busy_timeout = 100")
+  first.put('SELECT a FROM b', ('SELECT a FROM b', 'f1', None))
+  second.put('SELECT c FROM d', ('SELECT c FROM d', 'f2', None))
+  second.flush()
+  first.flush()
+  second.close()
+  first.close()
+
+  cache = QueryCache(db_path=cache_file)
+  assert cache.get('SELECT a FROM b') == ('SELECT a FROM b', 'f1', None)
+  assert cache.get('SELECT c FROM d') == ('SELECT c FROM d', 'f2', None)
+  cache.close()
+
+def test_fingerprint_ignores_literals():
+  parser = LogParser()
+  query, fingerprint = parser.parse_query("SELECT a FROM b WHERE c = 'x' AND d IN (1, 2)", fingerprint=True)
+  assert query == "SELECT a FROM b WHERE c = 'x' AND d IN (1, 2)"
+  assert parser.parse_query("SELECT a FROM b WHERE c = 'y' AND d IN (3, 4, 5)", fingerprint=True)[1] == fingerprint
+  assert parser.parse_query("SELECT a FROM b WHERE e = 'x' AND d IN (1, 2)", fingerprint=True)[1] != fingerprint
+
+def test_deduplicator_counts_shapes():
+  deduplicator = QueryDeduplicator()
+  pairs = [('q1', 'f1'), ('q2', 'f2'), ('q3', 'f1')]
+  assert list(deduplicator.dedup(pairs)) == ['q1', 'q2']
+  assert deduplicator.counts() == [(2, 'q1'), (1, 'q2')]
+
+  bloom_deduplicator = QueryDeduplicator(bloom_capacity=100)
+  fingerprints = ['%016x' % (n * 2654435761) for n in range(50)]
+  assert all(bloom_deduplicator.add('q', f) for f in fingerprints)
+  assert not any(bloom_deduplicator.add('q', f) for f in fingerprints)
+
+def test_compressed_and_directory_logs(tmp_path):
+  path = 'tests/fixtures/single_line_queries.log'
+  expected = list(LogParser().extract_queries(path))
+  with open(path, 'rb') as f:
+    data = f.read()
+  for extension, module in (('gz', gzip), ('bz2', bz2), ('xz', lzma)):
+    with module.open(tmp_path / f'app.log.{extension}', 'wb') as f:
+      f.write(data)
+
+  for extension in ('gz', 'bz2', 'xz'):
+    assert list(LogParser().extract_queries(str(tmp_path / f'app.log.{extension}'))) == expected
+  assert list(LogParser().extract_queries(str(tmp_path))) == expected * 3
+  assert list(LogParser().extract_queries_parallel(str(tmp_path / 'app.log.*'), workers=2)) == expected * 3
+
+def test_follow_resumes_from_checkpoint_and_handles_rotation(tmp_path):
+  log_file = tmp_path / 'app.log'
+  checkpoint_file = str(tmp_path / 'app.checkpoint')
+  log_file.write_text("a SELECT a FROM b\nb SELECT c FROM d\n")
+  follow = lambda: list(LogParser().follow_queries(str(log_file), checkpoint_file, poll_interval=0.01, idle_timeout=0.05,
+                                                    flush_after=0.02))
+
+  assert follow() == ['SELECT a FROM b', 'SELECT c FROM d']
+  with open(log_file, 'a') as f:
+    f.write("c SELECT e FROM f\nd SELECT partial")
+  assert follow() == ['SELECT e FROM f']
+
+  os.rename(log_file, tmp_path / 'app.log.1')
+  log_file.write_text("e SELECT g FROM h\n")
+  assert follow() == ['SELECT g FROM h']
+
+  log_file.write_text("SELECT i FROM j\n")
+  assert follow() == ['SELECT i FROM j']
+
+def test_follow_resumes_pending_statement(tmp_path):
+  log_file = tmp_path / 'app.log'
+  checkpoint_file = str(tmp_path / 'app.checkpoint')
+  follow = lambda: list(LogParser().follow_queries(str(log_file), checkpoint_file, poll_interval=0.01, idle_timeout=0.05,
+                                                    flush_after=0.02))
+
+  log_file.write_text("x SELECT a,\n")
+  assert follow() == []
+  with open(log_file, 'a') as f:
+    f.write("  b FROM t\n")
+  assert follow() == ['SELECT a, b FROM t']
+
+  # statements completed before the pending one on its first line are not repeated
+  with open(log_file, 'a') as f:
+    f.write("y ü SELECT c FROM u; SELECT d,\n")
+  assert follow() == ['SELECT c FROM u']
+  with open(log_file, 'a') as f:
+    f.write("  e FROM v\n")
+  assert follow() == ['SELECT d, e FROM v']
+
+def test_follow_waits_for_continuation_lines(tmp_path):
+  log_file = tmp_path / 'app.log'
+  log_file.write_text("x SELECT a, b FROM t\n")
+  def write_where():
+    time.sleep(0.2)
+    with open(log_file, 'a') as f:
+      f.write("  WHERE c = 1\n")
+  writer = threading.Thread(target=write_where)
+  writer.start()
+  queries = list(LogParser().follow_queries(str(log_file), poll_interval=0.01, idle_timeout=1.0, flush_after=0.5))
+  writer.join()
+  assert queries == ['SELECT a, b FROM t WHERE c = 1'] == list(LogParser().extract_queries(str(log_file)))
+
+def test_multi_line_and_multi_statement_queries():
+  path = 'tests/fixtures/multi_line_queries.log'
+  queries = list(LogParser().extract_queries(path))
+  assert queries == [
+    "SELECT id, name FROM reports WHERE owner_id = 7 AND state IN ('open', 'closed') ORDER BY created_at DESC",
+    'SELECT a FROM audits',
+    "SELECT b FROM audits WHERE c = 'x;y'",
+    'WITH totals AS (SELECT owner_id, COUNT(*) AS n FROM reports GROUP BY owner_id) SELECT owner_id FROM totals WHERE n > 1',
+  ]
+  for chunk_size in (1, 50, 100, 200):
+    assert list(LogParser().extract_queries_parallel(path, workers=2, chunk_size=chunk_size)) == queries
+
+def test_statement_assembler_starts_new_log_record():
+  # a line ending mid-clause doesn't continue into the next log record's statement
+  assembler = StatementAssembler()
+  assert assembler.feed('I, [12:00:01] SELECT a FROM t WHERE b = 1 AND') == []
+  assert assembler.feed('I, [12:00:02] SELECT c FROM d') == ['SELECT a FROM t WHERE b = 1 AND']
+  assert assembler.flush() == ['SELECT c FROM d']
+
+  # a statement start with no log text before it still continues the statement
+  assert assembler.feed('I, [12:00:03] SELECT a FROM t WHERE b IN') == []
+  assert assembler.feed('  (SELECT c FROM d)') == []
+  assert assembler.flush() == ['SELECT a FROM t WHERE b IN\n  (SELECT c FROM d)']
+
+def test_truncated_quoted_query_ends_at_next_log_record():
+  path = 'tests/fixtures/truncated_quote.log'
+  assert list(LogParser().extract_queries(path)) == ['SELECT users.* FROM users WHERE users', 'SELECT id FROM reports']
+  assert list(LogParser().extract_queries_parallel(path, workers=2, chunk_size=100)) == [
+    'SELECT users.* FROM users WHERE users', 'SELECT id FROM reports']
+
+def test_any_parse_exception_reported():
+  parser = LogParser()
+  for _ in range(2):
+    assert parser.parse_query('SELECT "a\nb" FROM t') is None
+  assert parser.stats['errors'] == 2
+  [((category, position), count)] = parser.errors.most_common()
+  assert category.startswith('SyntaxError: ') and count == 2
+
+def test_statement_assembler_drops_oversized_statements():
+  assembler = StatementAssembler(max_chars=20)
+  assert assembler.feed('SELECT a FROM (') == []
+  assert assembler.feed('  SELECT b FROM c WHERE d = 1') == []
+  assert assembler.stats['oversized'] == 1
+  assert assembler.feed(') AS e') == []
+  assert assembler.flush() == []
+
+def test_errors_reported_to_sink_not_stderr(tmp_path, capsys):
+  error_file = tmp_path / 'errors.jsonl'
+  parser = LogParser(error_file=str(error_file))
+  assert parser.parse_query('SELECT FROM') is None
+  assert parser.parse_query('SELECT , FROM') is None
+  parser.close()
+
+  assert capsys.readouterr().err == ''
+  assert parser.stats['errors'] == 2
+  assert sum(parser.errors.groups.values()) == 2
+  errors = [json.loads(line) for line in error_file.read_text().splitlines()]
+  assert [error['text'] for error in errors] == ['SELECT', 'SELECT']
+  assert all(error['category'] and error['position'] == 6 for error in errors)
+
+  LogParser(verbose=True).parse_query('SELECT FROM')
+  assert 'Error parsing query' in capsys.readouterr().err
+
+def test_cached_errors_reported_on_every_hit(tmp_path):
+  error_file = tmp_path / 'errors.jsonl'
+  cache_file = str(tmp_path / 'queries.sqlite')
+  parser = LogParser(cache_file=cache_file, error_file=str(error_file))
+  for _ in range(5):
+    assert parser.parse_query('SELECT FROM') is None
+  parser.close()
+  assert parser.stats['parsed'] == 1
+  assert parser.stats['errors'] == 5
+  assert list(parser.errors.groups.values()) == [5]
+
+  # failures kept in the cache file are reported in later runs too
+  parser = LogParser(cache_file=cache_file, error_file=str(error_file))
+  assert parser.parse_query('SELECT FROM') is None
+  parser.close()
+  assert parser.stats['parsed'] == 0 and parser.stats['cache_store_hits'] == 1
+  assert sum(parser.errors.groups.values()) == 1
+  errors = [json.loads(line) for line in error_file.read_text().splitlines()]
+  assert len(errors) == 6 and all(error == errors[0] for error in errors)
+  assert errors[0]['text'] == 'SELECT' and errors[0]['position'] == 6
@@ -0,0 +1,70 @@
+"""
+Benchmarks building the Spider schema from large synthetic GMLs
+"""
+
+import argparse
+import time
+import gml_csv_2_spider_schema_json as gml
+from benchmark_process_sql import load_baseline
+
+COLUMNS_PER_TABLE = 5
+
+def synthetic_gml(n_columns, columns_per_table=COLUMNS_PER_TABLE):
+  """
+  GML rows of n_columns columns, grouped by table. Every table has a primary
+  key, and a column joinable to the primary key of the table before it.
+  """
+  rows = []
+  for idx in range(n_columns):
+    table, column = divmod(idx, columns_per_table)
+    if column == 0:
+      name, joinable_to = 'ID', ''
+    elif column == 1 and table > 0:
+      name, joinable_to = f'Table {table - 1} ID', f'Table {table - 1}.ID'
+    else:
+      name, joinable_to = f'Column {column}', ''
+    rows.append({'Table': f'Table {table}', 'Column': name, 'Type': 'INTEGER' if column < 2 else 'STRING',
+                 'Primary Key': 'yes' if column == 0 else '', 'Description': f'Column {column} of table {table}',
+                 'Joinable to': joinable_to})
+  return rows
+
+def build_schema(module, schema_db):
+  # names are normalized once per process, so each run starts with empty caches
+  for func in (module.underscore, module.clean_column_table_name):
+    if hasattr(func, 'cache_clear'):
+      func.cache_clear()
+  schema_dict, col_index_dict = module.create_schema_json(schema_db)
+  tables_json = module.get_spider_table(schema_dict, 'benchmark')
+  tables_json['foreign_keys'] = module.define_foreign_keys(schema_dict, col_index_dict)
+  return schema_dict, tables_json
+
+def seconds(func, *args):
+  start = time.perf_counter()
+  result = func(*args)
+  return time.perf_counter() - start, result
+
+def benchmark(sizes, columns_per_table=COLUMNS_PER_TABLE, baseline_path=None):
+  baseline = load_baseline(baseline_path) if baseline_path else None
+  for n_columns in sizes:
+    schema_db = synthetic_gml(n_columns, columns_per_table)
+    after, result = seconds(build_schema, gml, schema_db)
+    if baseline is None:
+      print(f"{n_columns:8d} columns: {after:8.2f}s")
+      continue
+    before, baseline_result = seconds(build_schema, baseline, schema_db)
+    assert baseline_result == result
+    print(f"{n_columns:8d} columns  before: {before:8.2f}s   after: {after:8.2f}s   speedup: {before / after:.1f}x")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--columns', '-n', dest='columns', type=int, nargs='+', default=[1000, 10000, 100000], help='GML sizes to benchmark, in columns; default=1000 10000 100000')
+  parser.add_argument('--columns-per-table', '-c', dest='columns_per_table', type=int, default=COLUMNS_PER_TABLE, help=f'Columns of each synthetic table; default={COLUMNS_PER_TABLE}')
+  parser.add_argument('--baseline', dest='baseline', type=str, help='Another version of gml_csv_2_spider_schema_json.py to compare with')
+  args = parser.parse_args()
+
+  benchmark(args.columns, args.columns_per_table, args.baseline)
+
+# Example usage -
+# python benchmark_gml_csv_2_spider_schema_json.py -n 1000 10000 100000
+# git show HEAD~1:preprocessing/gml_csv_2_spider_schema_json.py > /tmp/gml_before.py
+# python benchmark_gml_csv_2_spider_schema_json.py -n 1000 10000 100000 -c 2 --baseline /tmp/gml_before.py
@@ -0,0 +1,152 @@
+"""
+Benchmarks process_sql on Spider style queries
+"""
+
+import argparse
+import importlib.util
+import time
+import process_sql
+from nltk import word_tokenize
+from process_sql import Schema, get_sql, tokenize
+
+SPIDER_QUERIES = [
+  "SELECT count(*) FROM singer",
+  "SELECT name ,  country ,  age FROM singer ORDER BY age DESC",
+  "SELECT avg(age) ,  min(age) ,  max(age) FROM singer WHERE country  =  'France'",
+  "SELECT T2.name ,  count(*) FROM concert AS T1 JOIN stadium AS T2 ON T1.stadium_id  =  T2.stadium_id GROUP BY T1.stadium_id",
+  "SELECT name FROM stadium WHERE capacity >= 1000 AND capacity <= 5000 AND name != \"Glebe Park\"",
+  "SELECT name FROM stadium WHERE stadium_id NOT IN (SELECT stadium_id FROM concert)",
+  "SELECT country FROM singer WHERE age  >  40 INTERSECT SELECT country FROM singer WHERE age  <  30",
+  "SELECT T1.name FROM singer AS T1 JOIN concert AS T2 ON T1.singer_id = T2.singer_id WHERE T2.year BETWEEN 2014 AND 2015 LIMIT 3",
+  "SELECT DISTINCT country FROM singer WHERE name LIKE '%Hey%' OR age - 1 > 20",
+  "SELECT count(DISTINCT singer_id) FROM concert WHERE YEAR = (SELECT max(YEAR) FROM concert)",
+  "SELECT YEAR ,  count(*) FROM concert GROUP BY YEAR HAVING count(*)  >  1",
+  "SELECT name FROM singer WHERE song_name = 'It''s' AND x IN (1,2,3) AND y<>2;",
+  "SELECT T1.id FROM a AS T1 WHERE T1.note = 'n/a' AND T1.code = \"a-b.c\" AND T1.v >= -3.5 LIMIT 1.",
+  "SELECT `first name`, count(*) FROM people -- cannot be empty",
+]
+
+SPIDER_SCHEMA = {
+  'singer': ['singer_id', 'name', 'country', 'song_name', 'age', 'is_male'],
+  'concert': ['concert_id', 'concert_name', 'theme', 'stadium_id', 'year'],
+  'singer_in_concert': ['concert_id', 'singer_id'],
+  'stadium': ['stadium_id', 'location', 'name', 'capacity', 'highest', 'lowest', 'average'],
+}
+
+# Spider queries with subqueries, set operations and joins, parsed against SPIDER_SCHEMA
+NESTED_QUERIES = [
+  "SELECT name FROM stadium WHERE stadium_id NOT IN (SELECT stadium_id FROM concert)",
+  "SELECT song_name FROM singer WHERE age  >  (SELECT avg(age) FROM singer)",
+  "SELECT country FROM singer WHERE age  >  40 INTERSECT SELECT country FROM singer WHERE age  <  30",
+  "SELECT name FROM stadium EXCEPT SELECT T2.name FROM concert AS T1 JOIN stadium AS T2 ON T1.stadium_id  =  T2.stadium_id WHERE T1.year  =  2014",
+  "SELECT T2.name ,  count(*) FROM concert AS T1 JOIN stadium AS T2 ON T1.stadium_id  =  T2.stadium_id GROUP BY T1.stadium_id ORDER BY count(*) DESC LIMIT 1",
+  "SELECT T3.name FROM singer_in_concert AS T1 JOIN concert AS T2 ON T1.concert_id  =  T2.concert_id JOIN singer AS T3 ON T1.singer_id  =  T3.singer_id WHERE T2.year  =  2014",
+  "SELECT name ,  capacity FROM stadium WHERE average  >  (SELECT avg(average) FROM stadium WHERE capacity BETWEEN 5000 AND 10000) AND location != \"Raith Rovers\"",
+  "SELECT count(*) FROM concert WHERE stadium_id = (SELECT stadium_id FROM stadium ORDER BY capacity DESC LIMIT 1) OR year > 2000",
+  "SELECT T2.concert_name ,  T2.theme ,  count(*) FROM singer_in_concert AS T1 JOIN concert AS T2 ON T1.concert_id  =  T2.concert_id GROUP BY T2.concert_id HAVING count(*) >= 2",
+  "SELECT DISTINCT T1.name FROM singer AS T1 JOIN singer_in_concert AS T2 ON T1.singer_id = T2.singer_id WHERE T1.song_name LIKE '%Hey%' UNION SELECT name FROM singer WHERE is_male = 'T'",
+]
+
+def nltk_tokenize(string):
+  """
+  tokenize() as it was with nltk.word_tokenize, as reference for tests and
+  benchmarks. The queries are single sentences, so preserve_line gives the
+  same tokens as sentence splitting with punkt.
+  """
+  string = str(string)
+  string = string.replace("\'\"","\"")
+  string = string.replace("\"\'","\"")
+  string = string.replace("\'", "\"")
+  quote_idxs = [idx for idx, char in enumerate(string) if char == '"']
+  assert len(quote_idxs) % 2 == 0, "Unexpected quote"
+
+  vals = {}
+  for i in range(len(quote_idxs)-1, -1, -2):
+    qidx1 = quote_idxs[i-1]
+    qidx2 = quote_idxs[i]
+    val = string[qidx1: qidx2+1]
+    key = "__val_{}_{}__".format(qidx1, qidx2)
+    string = string[:qidx1] + key + string[qidx2+1:]
+    vals[key] = val
+
+  toks = [word.lower() for word in word_tokenize(string, preserve_line=True)]
+  for i in range(len(toks)):
+    if toks[i] in vals:
+      toks[i] = vals[toks[i]]
+
+  eq_idxs = [idx for idx, tok in enumerate(toks) if tok == "="]
+  eq_idxs.reverse()
+  prefix = ('!', '>', '<')
+  for eq_idx in eq_idxs:
+    pre_tok = toks[eq_idx-1]
+    if pre_tok in prefix:
+      toks = toks[:eq_idx-1] + [pre_tok + "="] + toks[eq_idx+1: ]
+
+  return toks
+
+def queries_per_second(func, queries, iterations):
+  start = time.perf_counter()
+  for _ in range(iterations):
+    for query in queries:
+      func(query)
+  return iterations * len(queries) / (time.perf_counter() - start)
+
+def report(name, before, after):
+  print(f"{name:12s} before: {before:10.0f} queries/sec   after: {after:10.0f} queries/sec   speedup: {after / before:.1f}x")
+
+def benchmark_tokenize(iterations):
+  # long WHERE clauses show the quadratic list slicing of the old != / >= / <= join
+  long_query = "SELECT a FROM t WHERE " + " AND ".join(f"c{i} >= {i}" for i in range(200))
+  report('tokenize', queries_per_second(nltk_tokenize, SPIDER_QUERIES, iterations), queries_per_second(tokenize, SPIDER_QUERIES, iterations))
+  report('long where', queries_per_second(nltk_tokenize, [long_query], iterations // 10 or 1), queries_per_second(tokenize, [long_query], iterations // 10 or 1))
+
+def load_baseline(path):
+  """process_sql module from another version of the file, to benchmark against"""
+  spec = importlib.util.spec_from_file_location('baseline_process_sql', path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+def parse_sql_timer(module, schema):
+  """Times module.parse_sql alone on pre-tokenized queries"""
+  tokenized = {query: tokenize(query) for query in NESTED_QUERIES}
+  def parse(query):
+    toks = list(tokenized[query])  # parse_value rewrites true/false in place
+    return module.parse_sql(toks, 0, module.get_tables_with_alias(schema.schema, toks), schema)[1]
+  return parse
+
+def benchmark_parse(iterations, baseline_path=None):
+  schema = Schema(SPIDER_SCHEMA)
+  timers = {
+    'get_sql': lambda query: get_sql(schema, query),
+    'parse_sql': parse_sql_timer(process_sql, schema),
+  }
+  if baseline_path is None:
+    for name, timer in timers.items():
+      print(f"{name:12s} {queries_per_second(timer, NESTED_QUERIES, iterations):10.0f} queries/sec")
+    return
+
+  baseline = load_baseline(baseline_path)
+  baseline_schema = baseline.Schema(SPIDER_SCHEMA)
+  baseline_timers = {
+    'get_sql': lambda query: baseline.get_sql(baseline_schema, query),
+    'parse_sql': parse_sql_timer(baseline, baseline_schema),
+  }
+  for name, timer in timers.items():
+    for query in NESTED_QUERIES:
+      assert baseline_timers[name](query) == timer(query), query
+    report(name, queries_per_second(baseline_timers[name], NESTED_QUERIES, iterations), queries_per_second(timer, NESTED_QUERIES, iterations))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--iterations', '-n', dest='iterations', type=int, default=200, help='Times to run over the benchmark queries; default=200')
+  parser.add_argument('--baseline', dest='baseline', type=str, help='Another version of process_sql.py to compare parse speed with')
+  args = parser.parse_args()
+
+  benchmark_tokenize(args.iterations)
+  benchmark_parse(args.iterations, args.baseline)
+
+# Example usage -
+# python benchmark_process_sql.py -n 200
+# git show HEAD~1:preprocessing/process_sql.py > /tmp/process_sql_before.py
+# python benchmark_process_sql.py -n 200 --baseline /tmp/process_sql_before.py
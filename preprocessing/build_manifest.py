@@ -0,0 +1,67 @@
+"""
+Build manifest for skipping the rebuild of Spider artifacts whose inputs have not changed
+"""
+
+import hashlib
+import json
+import os
+
+READ_BUFFER_SIZE = 1024 * 1024
+
+def file_hash(path):
+  digest = hashlib.blake2b(digest_size=16)
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(READ_BUFFER_SIZE), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+def config_hash(config):
+  return hashlib.blake2b(json.dumps(config, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+
+class BuildManifest:
+  """
+  Records, for each artifact built, the hashes of its input files, of the
+  config it was built with and of the artifact itself. An artifact is current
+  while all of those still match, so it need not be rebuilt. Paths are kept
+  relative to the manifest, so it stays valid when the tree is moved.
+  """
+  def __init__(self, path):
+    self.path = path
+    self.directory = os.path.dirname(os.path.abspath(path))
+    self.entries = {}
+    self.hashes = {}
+    if os.path.exists(path):
+      with open(path) as f:
+        self.entries = json.load(f)
+
+  def is_current(self, artifact, inputs, config=None):
+    entry = self.entries.get(self.relative(artifact))
+    return entry is not None and os.path.exists(artifact) and entry == self._entry(artifact, inputs, config)
+
+  def record(self, artifact, inputs, config=None):
+    self.entries[self.relative(artifact)] = self._entry(artifact, inputs, config)
+
+  def save(self):
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(self.entries, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, self.path)
+
+  def relative(self, path):
+    return os.path.relpath(os.path.abspath(path), self.directory)
+
+  def _entry(self, artifact, inputs, config):
+    return {
+      'inputs': {self.relative(path): self._file_hash(path) for path in inputs},
+      'config': config_hash(config),
+      'hash': self._file_hash(artifact),
+    }
+
+  def _file_hash(self, path):
+    # files are hashed once per run unless they change
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = self.hashes.get(path)
+    if cached is None or cached[0] != signature:
+      cached = self.hashes[path] = (signature, file_hash(path))
+    return cached[1]
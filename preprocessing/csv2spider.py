@@ -3,29 +3,65 @@ Converts sql+question CSV into Spider format JSON
 """
 
 import argparse
-from process_sql import get_sql
-import sqlparse
+from build_manifest import BuildManifest
+import csv
+import functools
+import multiprocessing
+import os
+from process_sql import DEFAULT_CACHE_SIZE, MISSING, PARSE_CACHE_VERSION, ParseCache, SqlParser, cache_key, schema_fingerprint
+from spider_ir import ColumnTable, CompactSql, SpiderJsonWriter
+from sqlparse import tokens as T
+from sqlparse.engine import FilterStack
 import pandas as pd
-import nltk
 import json
-nltk.download('punkt')
+
+DEFAULT_CHUNK_SIZE = 10000
+# Splits SQL into statements of lexer tokens, without sqlparse.parse's grouping into a tree
+STATEMENT_SPLITTER = FilterStack()
+NLTK_DATA = ('punkt_tab', 'punkt')
+
+@functools.lru_cache(maxsize=None)
+def nltk_punkt_available():
+  """Whether nltk.word_tokenize has the punkt sentence splitter data it needs, checked once per process"""
+  import nltk
+  try:
+    nltk.word_tokenize("Check.")
+    return True
+  except LookupError:
+    print("NLTK punkt data not found, tokenizing each text as one sentence. Run with --download-nltk-data to install it.")
+    return False
+
+def download_nltk_data():
+  import nltk
+  for resource in NLTK_DATA:
+    nltk.download(resource)
+  nltk_punkt_available.cache_clear()
+
+def word_tokenize(text):
+  """
+  nltk.word_tokenize, or without punkt data its word tokenizer on the whole
+  text, which only differs on texts of several sentences
+  """
+  import nltk
+  return nltk.word_tokenize(text, preserve_line=not nltk_punkt_available())
 
 class SpiderQuery:
-  def __init__(self, query, query_no_value, question, db_id, schema):
+  def __init__(self, parsed_query, question, db_id):
+    """
+    :param parsed_query: (query, query_toks, query_toks_no_value, sql) from parse_query
+    """
     self.db_id = db_id
-    self.query = query
+    self.query, self.query_toks, self.query_toks_no_value, self.sql = parsed_query
 
     self.question = question
     try:
-      self.question_toks = nltk.word_tokenize(self.question)
-      self.query_toks = nltk.word_tokenize(self.query)
-      self.query_toks_no_value = nltk.word_tokenize(query_no_value)
+      self.question_toks = word_tokenize(self.question)
     except:
       self.question = None
+    if self.query_toks is None:
+      self.question = None
       self.query = None
 
-    self.sql = get_sql(schema, query)
-
   def to_json(self):
     return vars(self)
 
@@ -120,50 +156,143 @@ def get_schemas_from_json(fpath):
 
   return schemas, db_names, tables
 
-def process_csv(input_file, schema, db_id, output_file):
-  def visit(node, func):
-    if node:
-      func(node)
+def first_statement(q):
+  statement = next(STATEMENT_SPLITTER.run(q), None)
+  if statement is None:
+    raise IndexError("No SQL statement in query: {}".format(q))
+  return statement
 
-    if isinstance(node, sqlparse.sql.TokenList):
-      for t in node.tokens:
-        visit(t, func)
-
-  def remove_value_visitor(node):
-    if "Token.Literal.String" in str(node.ttype):
-      node.value = "value"
-    elif "Token.Literal.Number" in str(node.ttype):
-      node.value = "value"
-
-  data = pd.read_csv(input_file)
-  if 'label' not in data.columns or 'query' not in data.columns:
-    raise Exception("Input CSV must contain label and query columns. Check if the file has a heading row.")
+def strip_values(q):
+  """
+  :returns (query, query_no_value) where query is the first statement of q,
+  and query_no_value is it lowercased with string and number literals
+  replaced by "value"
+  """
+  statement = first_statement(q)
+  query = str(statement)
 
-  queries = []
-  query_texts = []
+  # query_toks_no_value needs lowercase tokens. Lowercasing only changes how
+  # the lexer splits q when it changes its length, as for 'İ'
+  lowered = q.lower()
+  lowered_statement = statement if len(lowered) == len(q) else first_statement(lowered)
+  query_no_value = ''.join(
+    "value" if token.ttype in T.String or token.ttype in T.Number else token.value.lower()
+    for token in lowered_statement.tokens)
 
-  for index, row in data.iterrows():
-    question = row['label']
-    if type(question) is not str:
-      continue
-    question = question.replace('"', "'")
-    question = question.replace("\t", " ")
+  return query, query_no_value
 
-    q = row['query']
-    q = q.replace("\t", " ")
+def parse_query(q, sql_parser):
+  """
+  The Spider fields that depend only on the query text, as (query,
+  query_toks, query_toks_no_value, sql). The toks are None if nltk fails.
+  """
+  query, query_no_value = strip_values(q)
 
-    sql_statement = sqlparse.parse(q)[0]
-    query = str(sql_statement)
+  try:
+    query_toks = word_tokenize(query)
+    query_toks_no_value = word_tokenize(query_no_value)
+  except:
+    query_toks = query_toks_no_value = None
 
-    # query_toks_no_value needs lowercase tokens
-    sql_statement = sqlparse.parse(q.lower())[0]
-    visit(sql_statement, remove_value_visitor) # replace values with placeholders
-    query_no_value = str(sql_statement)
+  return query, query_toks, query_toks_no_value, sql_parser.get_sql(query)
 
-    spider_query = SpiderQuery(query, query_no_value, question, db_id, schema).to_json()
-    if spider_query['query'] and spider_query['question'] and len(spider_query['question_toks']) > 0:
-      queries.append(spider_query)
-      query_texts.append(q)
+def read_csv_rows(input_file, chunk_size=DEFAULT_CHUNK_SIZE):
+  """
+  Generator of lists of up to chunk_size (question, query text) rows of
+  input_file, cleaned and without the rows that have no question
+  """
+  for chunk in pd.read_csv(input_file, chunksize=chunk_size, dtype=str):
+    if 'label' not in chunk.columns or 'query' not in chunk.columns:
+      raise Exception("Input CSV must contain label and query columns. Check if the file has a heading row.")
+
+    rows = []
+    for question, q in zip(chunk['label'], chunk['query']):
+      if type(question) is not str:
+        continue
+      question = question.replace('"', "'")
+      question = question.replace("\t", " ")
+
+      q = q.replace("\t", " ")
+      rows.append((question, q))
+    yield rows
+
+def iter_csv_queries(input_file, schema, db_id, compact_sql=False, cache=None, chunk_size=DEFAULT_CHUNK_SIZE, workers=None,
+                     pool=None):
+  """
+  Generator of (query text, Spider query dict) for the usable rows of
+  input_file, in file order. Reads chunk_size rows at a time so memory does
+  not grow with the input.
+  :param cache: ParseCache for parse_query results, keyed by schema and query text
+  :param workers: with workers > 1, the distinct queries of each chunk that
+    are not cached are parsed in a process pool, each worker getting the schema once
+  :param pool: process pool from worker_pool, with db_id's schema, to use instead of starting one
+  """
+  sql_parser = SqlParser(schema)
+  columns = ColumnTable() if compact_sql else None
+  # query tokens depend on whether nltk has punkt data, so cached ones are keyed by it
+  fingerprint = schema_fingerprint(schema) + ('/punkt' if nltk_punkt_available() else '')
+
+  own_pool = None
+  if pool is None and workers is not None and workers > 1:
+    pool = own_pool = worker_pool({db_id: schema}, workers)
+
+  try:
+    for rows in read_csv_rows(input_file, chunk_size):
+      parsed_queries = {}
+      missing = []
+      for _, q in rows:
+        if q in parsed_queries:
+          continue
+        parsed_query = cache.get(cache_key('spider_query', fingerprint, q)) if cache is not None else MISSING
+        if parsed_query is MISSING:
+          missing.append(q)
+        parsed_queries[q] = parsed_query
+
+      if pool is not None:
+        tasks = [(db_id, q) for q in missing]
+        results = pool.imap(_parse_query_in_worker, tasks, max(1, len(missing) // ((workers or 1) * 4)))
+      else:
+        results = (parse_query(q, sql_parser) for q in missing)
+      for q, parsed_query in zip(missing, results):
+        parsed_queries[q] = parsed_query
+        # nltk failures are not cached, so those queries are retried on later runs
+        if cache is not None and parsed_query[1] is not None:
+          cache.put(cache_key('spider_query', fingerprint, q), parsed_query)
+
+      for question, q in rows:
+        spider_query = SpiderQuery(parsed_queries[q], question, db_id).to_json()
+        if spider_query['query'] and spider_query['question'] and len(spider_query['question_toks']) > 0:
+          if columns is not None:
+            spider_query['sql'] = CompactSql.from_spider(spider_query['sql'], columns)
+          yield q, spider_query
+  finally:
+    if own_pool is not None:
+      own_pool.terminate()
+      own_pool.join()
+
+def worker_pool(schemas, workers):
+  """Process pool for parse_query, each worker getting the {db_id: schema} once"""
+  return multiprocessing.Pool(workers, initializer=_init_worker, initargs=(schemas,))
+
+_worker_parsers = None
+
+def _init_worker(schemas):
+  global _worker_parsers
+  _worker_parsers = {db_id: SqlParser(schema) for db_id, schema in schemas.items()}
+
+def _parse_query_in_worker(task):
+  db_id, q = task
+  return parse_query(q, _worker_parsers[db_id])
+
+def process_csv(input_file, schema, db_id, output_file, compact_sql=False, cache=None, workers=None):
+  """
+  :returns (query texts, Spider query dicts) for all the usable rows of input_file
+  """
+  query_texts = []
+  queries = []
+  for q, spider_query in iter_csv_queries(input_file, schema, db_id, compact_sql, cache, workers=workers):
+    query_texts.append(q)
+    queries.append(spider_query)
 
   return query_texts, queries
 
@@ -174,33 +303,186 @@ def write_gold_file(query_texts, db_id, gold_file):
       f.write("%s\t%s\n" % (q, db_id))
   print("Done")
 
-def process(db_id, input_file, table_file, fix_table_file_column_types, output_file):
+def open_build_manifest(build_manifest, cache_file):
+  """
+  :returns (BuildManifest or None, cache file). Incremental builds keep their
+  parse cache by the manifest, so an input that changed only parses its new queries
+  """
+  if not build_manifest:
+    return None, cache_file
+  return BuildManifest(build_manifest), cache_file or os.path.splitext(build_manifest)[0] + '_parse_cache.db'
+
+def build_config(manifest, db_inputs, compact_json):
+  """What an output depends on besides its input files, for the build manifest"""
+  return {
+    'inputs': [[db_id, manifest.relative(input_file)] for db_id, input_file in db_inputs],
+    'compact_json': compact_json,
+    'punkt': nltk_punkt_available(),
+    'version': PARSE_CACHE_VERSION,
+  }
+
+def process(db_id, input_file, table_file, fix_table_file_column_types, output_file, compact_json=False,
+            cache_size=DEFAULT_CACHE_SIZE, cache_file=None, chunk_size=DEFAULT_CHUNK_SIZE, workers=None, build_manifest=None):
+  """
+  :param build_manifest: BuildManifest file. The output is not rebuilt if its
+    inputs and config are the same as when last built with it
+  """
   if fix_table_file_column_types:
     do_fix_table_file_column_types(table_file)
 
+  gold_file = output_file.replace(".json", "_gold.sql")
+  manifest, cache_file = open_build_manifest(build_manifest, cache_file)
+  if manifest:
+    inputs = [input_file, table_file]
+    config = build_config(manifest, [(db_id, input_file)], compact_json)
+    if all(manifest.is_current(artifact, inputs, config) for artifact in (output_file, gold_file)):
+      print("Up to date:", output_file)
+      return
+
   schemas, db_names, tables = get_schemas_from_json(table_file)
   schema = schemas[db_id]
   table = tables[db_id]
   schema = Schema(schema, table)
 
-  query_texts, queries = process_csv(args.input_file, schema, args.db_id, args.output_file)
-  print("Writing", output_file)
-  with open(output_file, 'w') as f:
-    json.dump(queries, f, sort_keys=True, indent=2, separators=(',', ': '))
+  # queries are written as they are converted, so only a chunk of the input is in memory at a time
+  print("Writing", output_file, "and gold file", gold_file)
+  cache = ParseCache(cache_size, cache_file)
+  try:
+    with SpiderJsonWriter(output_file, compact_json) as writer, open(gold_file, 'w') as gold:
+      for q, spider_query in iter_csv_queries(input_file, schema, db_id, cache=cache, chunk_size=chunk_size, workers=workers):
+        writer.write(spider_query)
+        gold.write("%s\t%s\n" % (q, db_id))
+  finally:
+    cache.close()
+  print("Wrote {} queries. Parsed {} distinct queries, {} cache hits".format(
+    writer.count, cache.stats['cache_misses'], cache.stats['cache_hits'] + cache.stats['cache_store_hits']))
+
+  if manifest:
+    for artifact in (output_file, gold_file):
+      manifest.record(artifact, inputs, config)
+    manifest.save()
   print("Done")
 
-  write_gold_file(query_texts, db_id, output_file.replace(".json", "_gold.sql"))
+def read_manifest(manifest_file):
+  """
+  :returns list of (db_id, input_file, output_file) from a CSV manifest with
+  those columns, paths being relative to the manifest
+  """
+  base_directory = os.path.dirname(os.path.abspath(manifest_file))
+  with open(manifest_file, newline='') as f:
+    reader = csv.DictReader(f)
+    if not reader.fieldnames or not {'db_id', 'input_file', 'output_file'} <= set(reader.fieldnames):
+      raise Exception("Manifest CSV must contain db_id, input_file and output_file columns. Check if the file has a heading row.")
+    return [(row['db_id'], os.path.join(base_directory, row['input_file']), os.path.join(base_directory, row['output_file']))
+            for row in reader]
+
+def process_manifest(manifest_file, table_file, fix_table_file_column_types, compact_json=False,
+                     cache_size=DEFAULT_CACHE_SIZE, cache_file=None, chunk_size=DEFAULT_CHUNK_SIZE, workers=None,
+                     build_manifest=None):
+  """
+  Converts every (db_id, input CSV) of the manifest, loading the table file
+  and building each database's schema once. Inputs with the same output file
+  are merged into it, and its gold file, in manifest order.
+  :param build_manifest: BuildManifest file. Outputs are not rebuilt if their
+    inputs and config are the same as when last built with it
+  """
+  manifest = read_manifest(manifest_file)
+  if fix_table_file_column_types:
+    do_fix_table_file_column_types(table_file)
+
+  build, cache_file = open_build_manifest(build_manifest, cache_file)
+  outputs = {}
+  for db_id, input_file, output_file in manifest:
+    outputs.setdefault(output_file, []).append((db_id, input_file))
+  if build:
+    builds = {}
+    for output_file, db_inputs in outputs.items():
+      inputs = [input_file for _, input_file in db_inputs] + [table_file]
+      config = build_config(build, db_inputs, compact_json)
+      artifacts = (output_file, output_file.replace(".json", "_gold.sql"))
+      if all(build.is_current(artifact, inputs, config) for artifact in artifacts):
+        print("Up to date:", output_file)
+      else:
+        builds[output_file] = (artifacts, inputs, config)
+    manifest = [row for row in manifest if row[2] in builds]
+    if not manifest:
+      return
+
+  schema_dicts, db_names, tables = get_schemas_from_json(table_file)
+  missing_db_ids = sorted({db_id for db_inputs in outputs.values() for db_id, _ in db_inputs} - set(db_names))
+  if missing_db_ids:
+    raise Exception("Databases not in {}: {}".format(table_file, ", ".join(missing_db_ids)))
+  schemas = {}
+  for db_id, _, _ in manifest:
+    if db_id not in schemas:
+      schemas[db_id] = Schema(schema_dicts[db_id], tables[db_id])
+
+  writers = {}
+  cache = ParseCache(cache_size, cache_file)
+  pool = worker_pool(schemas, workers) if workers is not None and workers > 1 else None
+  try:
+    for db_id, input_file, output_file in manifest:
+      if output_file not in writers:
+        gold_file = output_file.replace(".json", "_gold.sql")
+        print("Writing", output_file, "and gold file", gold_file)
+        writers[output_file] = (SpiderJsonWriter(output_file, compact_json), open(gold_file, 'w'))
+      writer, gold = writers[output_file]
+
+      print("Converting", input_file, "for", db_id)
+      for q, spider_query in iter_csv_queries(input_file, schemas[db_id], db_id, cache=cache, chunk_size=chunk_size,
+                                              workers=workers, pool=pool):
+        writer.write(spider_query)
+        gold.write("%s\t%s\n" % (q, db_id))
+  finally:
+    if pool is not None:
+      pool.terminate()
+      pool.join()
+    for writer, gold in writers.values():
+      writer.close()
+      gold.close()
+    cache.close()
+
+  print("Wrote {} queries to {} files. Parsed {} distinct queries, {} cache hits".format(
+    sum(writer.count for writer, _ in writers.values()), len(writers),
+    cache.stats['cache_misses'], cache.stats['cache_hits'] + cache.stats['cache_store_hits']))
+
+  if build:
+    for artifacts, inputs, config in builds.values():
+      for artifact in artifacts:
+        build.record(artifact, inputs, config)
+    build.save()
+  print("Done")
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
-  parser.add_argument('--db_id', '-d', dest='db_id', type=str, required=True, help='Database ID to output in the json file')
-  parser.add_argument('--input-file', '-i', dest='input_file', type=str, required=True, help='CSV file with two columns - "query" SQL query, "label" corresponding natural language question')
+  parser.add_argument('--db_id', '-d', dest='db_id', type=str, help='Database ID to output in the json file')
+  parser.add_argument('--input-file', '-i', dest='input_file', type=str, help='CSV file with two columns - "query" SQL query, "label" corresponding natural language question')
+  parser.add_argument('--manifest', '-m', dest='manifest', type=str, help='CSV file with columns db_id, input_file, output_file to convert many databases in one run, instead of --db_id, --input-file and --output-file. Inputs with the same output file are merged into it')
   parser.add_argument('--table-file', '-t', dest='table_file', type=str, required=True, help='JSON file with schema information in Spider format')
   parser.add_argument('--fix-table-file-column-types', '-f', action='store_true', dest='fix_table_file_column_types', default=False, help='Whether to map column types in tables json to one of boolean, foreign, number, others, primary, text, time. This is needed for GNN.')
-  parser.add_argument('--output-file', '-o', dest='output_file', type=str, required=True, help='JSON file in Spider format')
+  parser.add_argument('--output-file', '-o', dest='output_file', type=str, help='JSON file in Spider format')
+  parser.add_argument('--compact-json', action='store_true', dest='compact_json', default=False, help='Write one query per line without indentation, which is much faster for large outputs')
+  parser.add_argument('--cache-size', dest='cache_size', type=int, default=DEFAULT_CACHE_SIZE, help=f'Number of distinct queries to keep parsed in memory; default={DEFAULT_CACHE_SIZE}')
+  parser.add_argument('--workers', '-w', dest='workers', type=int, default=1, help='Number of worker processes to parse queries in; default=1 parses in this process')
+  parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=DEFAULT_CHUNK_SIZE, help=f'Number of CSV rows to read at a time; default={DEFAULT_CHUNK_SIZE}')
+  parser.add_argument('--cache-file', dest='cache_file', type=str, default=None, help='SQLite file to persist parsed queries across runs, so a rebuild only parses new or changed queries')
+  parser.add_argument('--download-nltk-data', action='store_true', dest='download_nltk_data', default=False, help='Download the NLTK punkt data first. Without it texts are tokenized as one sentence')
+  parser.add_argument('--build-manifest', '-b', dest='build_manifest', type=str, default=None, help='JSON file recording input hashes of the outputs built. Outputs whose inputs and options are unchanged are not rebuilt, and changed inputs only parse their new queries')
   args = parser.parse_args()
+  if not args.manifest and not (args.db_id and args.input_file and args.output_file):
+    parser.error("either --manifest or all of --db_id, --input-file and --output-file are required")
+
+  if args.download_nltk_data:
+    download_nltk_data()
 
-  process(args.db_id, args.input_file, args.table_file, args.fix_table_file_column_types, args.output_file)
+  if args.manifest:
+    process_manifest(args.manifest, args.table_file, args.fix_table_file_column_types, args.compact_json,
+                     args.cache_size, args.cache_file, args.chunk_size, args.workers, args.build_manifest)
+  else:
+    process(args.db_id, args.input_file, args.table_file, args.fix_table_file_column_types, args.output_file, args.compact_json,
+            args.cache_size, args.cache_file, args.chunk_size, args.workers, args.build_manifest)
 
 # Example usage -
 # python csv2spider.py -d SS30 -i ss30_traindev.csv -t SS30/ss30_tables.json -o ss30_traindev.json
+# python csv2spider.py -m manifest.csv -t tables.json -w 8
+# python csv2spider.py -m manifest.csv -t tables.json -b build.json  # converts only outputs whose inputs changed
@@ -3,66 +3,115 @@ Splits given CSV into train, dev and test CSV files
 """
 
 import argparse
-import pandas as pd
+import csv
 from pathlib import Path
-import subprocess
+import random
+
+SPLITS = ('dev', 'test', 'train')
 
 def prefix_file_path(file_path, prefix):
   file_name = Path(file_path).name
   prefixed_file_name = "%s_%s" % (prefix, file_name)
   return Path(file_path).parent / prefixed_file_name
 
-def print_file_line_count(file_path):
-  result = subprocess.run(['wc', '-l', file_path], stdout=subprocess.PIPE)
-  print("     > wc -l")
-  print(result.stdout.decode())
+class LineCountingFile:
+  """File wrapper counting the lines written through it"""
+  def __init__(self, file):
+    self.file = file
+    self.lines = 0
+
+  def write(self, text):
+    self.lines += text.count('\n')
+    return self.file.write(text)
 
-def write_data_to_file(record_count, data, original_file_path, prefix):
-  file_path = prefix_file_path(original_file_path, prefix)
-  print("Writing %d records to %s" % (record_count, prefix))
-  data.to_csv(path_or_buf=file_path)
-  print_file_line_count(file_path)
+def count_records(input_file):
+  """Records of the CSV file, not counting the header. Quoted values may span lines"""
+  with open(input_file, newline='') as f:
+    reader = csv.reader(f)
+    next(reader, None)
+    return sum(1 for _ in reader)
 
-def main(input_file, test_size, dev_size):
-  data = pd.read_csv(input_file)
-  data_size = len(data)
+def split_size(size, data_size):
+  if size < 1.0:
+    size = data_size * size
+  return int(size)
 
-  if test_size < 1.0:
-    test_size = data_size * test_size
-  test_size = int(test_size)
+def assign_splits(split_sizes, data_size, seed):
+  """
+  Generator of the index into split_sizes of each record, choosing every
+  possible assignment with the given sizes with equal probability. Each
+  record is picked for a split with probability of the records left to
+  assign to it, so only the counts need be kept.
+  """
+  rng = random.Random(seed)
+  remaining = list(split_sizes)
+  for records_left in range(data_size, 0, -1):
+    pick = rng.randrange(records_left)
+    for split, count in enumerate(remaining):
+      if pick < count:
+        remaining[split] -= 1
+        yield split
+        break
+      pick -= count
 
-  if dev_size < 1.0:
-    dev_size = data_size * dev_size
-  dev_size = int(dev_size)
+def main(input_file, test_size, dev_size, seed=None):
+  """
+  Streams the records of input_file to dev, test and train files in two
+  passes, the first counting records, so memory use does not grow with the
+  file. Records keep their input order within each file.
+  """
+  data_size = count_records(input_file)
+  test_size = split_size(test_size, data_size)
+  dev_size = split_size(dev_size, data_size)
+  if dev_size + test_size > data_size:
+    raise Exception(f"Dev and test sizes {dev_size} + {test_size} exceed the {data_size} records in {input_file}")
+  split_sizes = (dev_size, test_size, data_size - (dev_size + test_size))
 
-  # shuffle
-  data = data.sample(frac=1).reset_index(drop=True)
+  if seed is None:
+    seed = random.randrange(2 ** 32)
+  print("Splitting %d records with seed %d" % (data_size, seed))
 
-  if dev_size > 0:
-    write_data_to_file(dev_size, data[:dev_size], input_file, 'dev')
+  files = {}
+  try:
+    writers = []
+    for prefix, size in zip(SPLITS, split_sizes):
+      if size > 0 or prefix == 'train':
+        files[prefix] = LineCountingFile(open(prefix_file_path(input_file, prefix), 'w', newline=''))
+        writers.append(csv.writer(files[prefix], lineterminator='\n'))
+      else:
+        writers.append(None)
 
-  if test_size > 0:
-    write_data_to_file(test_size, data[dev_size:dev_size+test_size], input_file, 'test')
+    with open(input_file, newline='') as f:
+      reader = csv.reader(f)
+      header = next(reader, None)
+      if header is not None:
+        for writer in writers:
+          if writer is not None:
+            writer.writerow(header)
+      for split, row in zip(assign_splits(split_sizes, data_size, seed), reader):
+        writers[split].writerow(row)
+  finally:
+    for file in files.values():
+      file.file.close()
 
-  write_data_to_file(data_size-(dev_size+test_size), data[dev_size+test_size:], input_file, 'train')
+  for prefix, size in zip(SPLITS, split_sizes):
+    if prefix in files:
+      print("Wrote %d records to %s, %d lines" % (size, prefix_file_path(input_file, prefix), files[prefix].lines))
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
   parser.add_argument('--input-file', '-i', dest='input_file', type=str, required=True, help='CSV file to split')
   parser.add_argument('--test-size', '-t', dest='test_size', type=float, required=False, default=0.2, help='Size of test set: float to indicate fraction, or int to indicate count of records, or 0 to skip; default=0.2')
   parser.add_argument('--dev-size', '-d', dest='dev_size', type=float, required=False, default=0.2, help='Size of dev set: float to indicate fraction, or int to indicate count of records, or 0 to skip; default=0.2')
+  parser.add_argument('--seed', '-s', dest='seed', type=int, required=False, default=None, help='Random seed, to reproduce a split; default=random, printed')
   args = parser.parse_args()
 
-  main(args.input_file, args.test_size, args.dev_size)
+  main(args.input_file, args.test_size, args.dev_size, args.seed)
 
 # Example usage --
-# python csv_split_train_dev_test.py -i ss30_traindev.csv -t 0 -d 0.2
+# python csv_split_train_dev_test.py -i ss30_traindev.csv -t 0 -d 0.2 -s 7
 
 # Example output --
-# Writing 179 records to dev
-#      > wc -l
-#      185 dev_ss30_traindev.csv
-#
-# Writing 719 records to train
-#      > wc -l
-#      731 train_ss30_traindev.csv
\ No newline at end of file
+# Splitting 898 records with seed 7
+# Wrote 179 records to dev_ss30_traindev.csv, 185 lines
+# Wrote 719 records to train_ss30_traindev.csv, 731 lines
@@ -4,58 +4,166 @@ Example input: CSV generated from https://docs.google.com/spreadsheets/d/1og_gZ9
 """
 
 import argparse
+from build_manifest import BuildManifest
 import csv
+import functools
 import json
 import inflection
-import nltk
 import os
 from pathlib import Path
-import subprocess
+import re
+import sqlite3
 import pdb
 
+WORD_RE = re.compile(r'\w+')
+
 def process(args):
   output_directory = Path(args.output_directory)
-
-  print(f"Loading GML:                     {args.gml_csv_file}")
-  schema_db = load_gml(args.gml_csv_file)
-  # print("Parsing GML")
-  schema_dict, col_index_dict = create_schema_json(schema_db)
-  all_tables = set(schema_dict.keys())
-
   output_json_file = output_directory / f"{args.db_id}_schema.json"
-  print(f"Writing Spider schema json file: {output_json_file}")
-  with open(output_json_file, "w") as f:
-    json.dump(schema_dict, f, indent=2)
-
-  tables_json = get_spider_table(schema_dict, args.db_id)
-  f_keys = define_foreign_keys(schema_dict, col_index_dict)
-  tables_json['foreign_keys'] = f_keys
-
   tables_json_filename = output_directory / f"{args.db_id}_schema_tables.json"
-  print(f"Writing tables json file:        {tables_json_filename}")
-  with open(tables_json_filename, 'w') as f:
-    json.dump([tables_json], f, indent=2)
-
-  sql = get_sql(tables_json, schema_dict)
   sql_file = output_directory / f"{args.db_id}.sql"
-  print(f"Writing SQL file:                {sql_file}")
-  with open(sql_file, 'w') as f:
-    f.write(sql)
-
   sqlite_file = output_directory / f"{args.db_id}.sqlite"
+
+  build_manifest = getattr(args, 'build_manifest', None)
+  manifest = BuildManifest(build_manifest) if build_manifest else None
+  schema_files = (output_json_file, tables_json_filename, sql_file)
+  inputs = [args.gml_csv_file]
+  config = {'db_id': args.db_id}
+
+  if manifest and all(manifest.is_current(path, inputs, config) for path in schema_files):
+    print(f"Up to date:                      {sql_file}")
+    all_tables = None
+  else:
+    print(f"Loading GML:                     {args.gml_csv_file}")
+    schema_db = load_gml(args.gml_csv_file)
+    # print("Parsing GML")
+    schema_dict, col_index_dict = create_schema_json(schema_db)
+    all_tables = set(schema_dict.keys())
+
+    print(f"Writing Spider schema json file: {output_json_file}")
+    with open(output_json_file, "w") as f:
+      json.dump(schema_dict, f, indent=2)
+
+    tables_json = get_spider_table(schema_dict, args.db_id)
+    f_keys = define_foreign_keys(schema_dict, col_index_dict)
+    tables_json['foreign_keys'] = f_keys
+
+    print(f"Writing tables json file:        {tables_json_filename}")
+    with open(tables_json_filename, 'w') as f:
+      json.dump([tables_json], f, indent=2)
+
+    sql = get_sql(tables_json, schema_dict)
+    print(f"Writing SQL file:                {sql_file}")
+    with open(sql_file, 'w') as f:
+      f.write(sql)
+
+    if manifest:
+      for path in schema_files:
+        manifest.record(path, inputs, config)
+
+  if all_tables is None:
+    with open(tables_json_filename) as f:
+      all_tables = set(json.load(f)[0]['table_names_original'])
+  sample_data_directory = getattr(args, 'sample_data_directory', None)
+  sample_files = sample_data_files(sample_data_directory, all_tables) if sample_data_directory else {}
+  synthetic_rows = getattr(args, 'synthetic_rows', 0)
+
+  # the database only depends on the SQL file and the rows loaded, so it is rebuilt only when those changed
+  db_inputs = [sql_file] + sorted(sample_files.values())
+  db_config = {'synthetic_rows': synthetic_rows}
+  if manifest and manifest.is_current(sqlite_file, db_inputs, db_config):
+    print(f"Up to date:                      {sqlite_file}")
+  elif create_sqlite_db(sql_file, sqlite_file, all_tables, sample_files, synthetic_rows) and manifest:
+    manifest.record(sqlite_file, db_inputs, db_config)
+
+  if manifest:
+    manifest.save()
+
+def create_sqlite_db(sql_file, sqlite_file, all_tables, sample_files=None, synthetic_rows=0):
+  """
+  Creates the database from the SQL file in a single transaction, then loads
+  rows from the sample CSV files ({table: path}) and synthetic_rows generated
+  rows into every other table.
+  :returns whether the tables in the created database are those of the GML
+  """
   print(f"Creating SQLite database:        {sqlite_file}")
-  retval = os.system(f"rm -f {sqlite_file} && sqlite3 {sqlite_file} < {sql_file}")
+  for path in (sqlite_file, f"{sqlite_file}-journal"):
+    if os.path.exists(path):
+      os.remove(path)
+  with open(sql_file) as f:
+    sql = f.read()
+
+  conn = sqlite3.connect(sqlite_file)
+  try:
+    # the database is built from scratch, so there is nothing for a journal to protect
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute(f"PRAGMA cache_size = -{64 * 1024}")
+    conn.executescript(f"BEGIN;\n{sql}")
+    for table in sorted(all_tables):
+      if sample_files and table in sample_files:
+        print(f"Loading sample rows:             {sample_files[table]}")
+        load_sample_rows(conn, table, sample_files[table])
+      elif synthetic_rows:
+        load_synthetic_rows(conn, table, synthetic_rows)
+    conn.commit()
+
+    # verify database creation
+    tables_in_db = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+  finally:
+    conn.close()
 
-  # verify database creation
-  out = subprocess.Popen(['sqlite3', sqlite_file, '.tables'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-  stdout,stderr = out.communicate()
-  tables_in_db = set(stdout.decode('ascii').split())
   if all_tables != tables_in_db:
     print("ERROR: Tables written to database do no match tables in GML")
     print("   GML tables - ", ', '.join(all_tables))
     print("   DB tables  - ", ', '.join(tables_in_db))
-  else:
-    print("Verified DB contents")
+    return False
+  print("Verified DB contents")
+  return True
+
+def sample_data_files(sample_data_directory, all_tables):
+  """{table: path} of the <table>.csv files in the sample data directory"""
+  paths = {table: os.path.join(sample_data_directory, f"{table}.csv") for table in all_tables}
+  return {table: path for table, path in paths.items() if os.path.exists(path)}
+
+def load_sample_rows(conn, table, sample_file):
+  """Inserts the rows of a CSV file whose header names columns of the table. Empty values are NULL"""
+  with open(sample_file, newline='') as f:
+    reader = csv.reader(f)
+    columns = next(reader)
+    insert = "INSERT INTO {} ({}) VALUES ({})".format(table, ', '.join(columns), ', '.join('?' * len(columns)))
+    conn.executemany(insert, (tuple(value if value != '' else None for value in row) for row in reader))
+
+def load_synthetic_rows(conn, table, n_rows):
+  """
+  Inserts n_rows rows whose values follow the column types. Row i of a
+  foreign key column has the value of row i of the column it references, so
+  the rows of joined tables match.
+  """
+  columns = [(name, type) for _, name, type, _, _, _ in conn.execute(f"PRAGMA table_info({table})")]
+  references = {column: (ref_table, ref_column)
+                for _, _, ref_table, column, ref_column, *_ in conn.execute(f"PRAGMA foreign_key_list({table})")}
+  generators = []
+  for name, type in columns:
+    if name in references:
+      ref_table, ref_column = references[name]
+      ref_types = {ref_name: ref_type for _, ref_name, ref_type, _, _, _ in conn.execute(f"PRAGMA table_info({ref_table})")}
+      name, type = ref_column, ref_types.get(ref_column, type)
+    generators.append(synthetic_value_generator(name, type))
+
+  insert = "INSERT INTO {} ({}) VALUES ({})".format(table, ', '.join(name for name, _ in columns), ', '.join('?' * len(columns)))
+  conn.executemany(insert, (tuple(generate(i) for generate in generators) for i in range(n_rows)))
+
+def synthetic_value_generator(column, type):
+  """Function of the row number giving the column's value, distinct for each row where the type allows"""
+  spider_type = spider_column_type(type)
+  if spider_type == "number":
+    return lambda i: i + 1
+  if spider_type == "time":
+    return lambda i: "{:04d}-{:02d}-{:02d}".format(2000 + i // 336, i // 28 % 12 + 1, i % 28 + 1)
+  if spider_type == "boolean":
+    return lambda i: i % 2
+  return lambda i: f"{column} {i + 1}"
 
 def load_gml(gml_csv_file):
   with open(gml_csv_file) as f:
@@ -70,23 +178,23 @@ def load_gml(gml_csv_file):
 
   return schema_db
 
+# GML names repeat across rows, tables and joins, so each is normalized once
+@functools.lru_cache(maxsize=None)
 def underscore(s):
   return inflection.underscore(inflection.parameterize(s))
 
 def create_schema_json(schema_db):
-  n_columns = 0
+  """
+  :returns ({table: {column: column info}}, {"table.column": column index}),
+  tables and columns in the order they first appear in the GML. Rows of a
+  table need not be next to each other. Columns are numbered table by table,
+  as in get_spider_table.
+  """
   json_dict = {}
-  table_dict = {}
-  last_table = underscore(schema_db[0]['Table'])
-  column_index_dict = {}
-
-  for idx, item in enumerate(schema_db):
-    n_columns += 1
+  for item in schema_db:
     this_table = underscore(item['Table'])
     column = underscore(item["Column"])
-    column_index_dict[this_table + '.' + column] = idx + 1
     is_primary_column = item['Primary Key'] in ['primary_key', 'Primary Key', 'yes', 'Yes']
-    description = item["Description"]
 
     if item['Joinable to']:
       joinable_tables = item['Joinable to'].split('\n')
@@ -101,25 +209,22 @@ def create_schema_json(schema_db):
     else:
       final_joinable_tables = []
 
-    this_dict = {column: {"type": item["Type"], "rule": column, "is_primary": is_primary_column, "joinable_to": final_joinable_tables, "description": item["Description"]}}#"where_value_options": where_values}}
-    if this_table==last_table:
-      table_dict = {**table_dict, **this_dict}
-    else:
-      if table_dict:
-        new_table_dict = {last_table:table_dict}
-        # print('columns in table', item['Table'], len(table_dict))
-        json_dict = {**json_dict, **new_table_dict}
-        table_dict = this_dict
-      else:
-        table_dict = this_dict
-
-    last_table = this_table
-  new_table_dict = {last_table:table_dict}
-  json_dict = {**json_dict, **new_table_dict}
-
-  if len(table_dict.keys()) < 2:
+    table_dict = json_dict.get(this_table)
+    if table_dict is None:
+      table_dict = json_dict[this_table] = {}
+    table_dict[column] = {"type": item["Type"], "rule": column, "is_primary": is_primary_column, "joinable_to": final_joinable_tables, "description": item["Description"]}#"where_value_options": where_values}}
+
+  if not json_dict or len(json_dict[this_table].keys()) < 2:
     raise Exception("GNN requires at least 2 tables. Add a dummy table with 2 dummy columns if you have a single table in your GML.")
 
+  # column 0 is '*'
+  column_index_dict = {}
+  col_counter = 1
+  for table, table_info in json_dict.items():
+    for column in table_info:
+      column_index_dict[table + '.' + column] = col_counter
+      col_counter += 1
+
   # Make sure join columns are valid
   all_columns = set(column_index_dict.keys())
   for table, table_info in json_dict.items():
@@ -133,11 +238,24 @@ def create_schema_json(schema_db):
 
   return json_dict, column_index_dict
 
+@functools.lru_cache(maxsize=None)
 def clean_column_table_name(name):
-  tokenizer = nltk.tokenize.RegexpTokenizer(r'\w+')
-  inter = ' '.join(tokenizer.tokenize(name)).lower().replace('_', ' ').replace('-', ' ')
+  inter = ' '.join(WORD_RE.findall(name)).lower().replace('_', ' ').replace('-', ' ')
   return inter
 
+def clean_column_table_names(names):
+  return [clean_column_table_name(name) for name in names]
+
+def spider_column_type(type):
+  type_text = type.lower()
+  if type_text in ['integer', 'int', 'double', 'float']:
+    return "number"
+  elif type_text in ['datetime', 'time', 'date']:
+    return "time"
+  elif type_text in ['boolean']:
+    return "boolean"
+  return "text"
+
 def get_spider_table(db_info, db_id):
   new_table = {}
   new_table["column_names"] = []
@@ -155,19 +273,10 @@ def get_spider_table(db_info, db_id):
   new_table["column_names"].append([-1, "*"])
   new_table["column_types"].append('text')
   for table in db_info.keys():
-    for col in db_info[table]:
+    for col, clean_col in zip(db_info[table], clean_column_table_names(db_info[table])):
       new_table["column_names_original"].append([table_counter, col])
-      new_table["column_names"].append([table_counter, clean_column_table_name(col)])
-      type_text = db_info[table][col]['type'].lower()
-      if type_text in ['integer', 'int', 'double', 'float']:
-        type = "number"
-      elif type_text in ['datetime', 'time', 'date']:
-        type = "time"
-      elif type_text in ['boolean']:
-        type = "boolean"
-      else:
-        type = "text"
-      new_table["column_types"].append(type)
+      new_table["column_names"].append([table_counter, clean_col])
+      new_table["column_types"].append(spider_column_type(db_info[table][col]['type']))
       if db_info[table][col]['is_primary']:
         new_table['primary_keys'].append(col_counter)
       col_counter += 1
@@ -178,13 +287,14 @@ def get_spider_table(db_info, db_id):
 
 def define_foreign_keys(db_info, col_index_dict):
   foreign_keys_list = []
-  res = []
+  seen = set()
   for table in db_info.keys():
     for col in db_info[table]:
       if db_info[table][col]["joinable_to"]:
         for join_tab_col in db_info[table][col]["joinable_to"]:
           f_list = sorted([col_index_dict[table+'.'+col], col_index_dict[join_tab_col]])
-          if f_list not in foreign_keys_list:
+          if tuple(f_list) not in seen:
+            seen.add(tuple(f_list))
             foreign_keys_list.append(f_list)
   return foreign_keys_list
 
@@ -224,6 +334,9 @@ if __name__ == "__main__":
   parser.add_argument('--db_id', '-d', dest='db_id', type=str, required=True, help='Database ID')
   parser.add_argument('--gml-csv-file', '-g', dest='gml_csv_file', type=str, required=True, help='GML CSV file, e.g. created from https://docs.google.com/spreadsheets/d/1og_gZ9oINInEO4CHpdPMIvg106qlj49fKNxVFWGL5Ww/edit#gid=1302477593')
   parser.add_argument('--output-directory', '-o', dest='output_directory', type=str, required=True, help='Output directory to generate files')
+  parser.add_argument('--sample-data-directory', '-s', dest='sample_data_directory', type=str, default=None, help='Directory of <table>.csv files, with a header of column names, whose rows are loaded into the SQLite database')
+  parser.add_argument('--synthetic-rows', '-n', dest='synthetic_rows', type=int, default=0, help='Rows of generated values to load into tables without sample data; default=0')
+  parser.add_argument('--build-manifest', '-b', dest='build_manifest', type=str, default=None, help='JSON file recording input hashes of the files generated. Files whose inputs are unchanged are not generated again')
   args = parser.parse_args()
 
   process(args)
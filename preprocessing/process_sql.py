@@ -26,9 +26,13 @@
 # }
 ################################
 
+import hashlib
 import json
+import multiprocessing
+import pickle
+import re
 import sqlite3
-from nltk import word_tokenize
+from collections import ChainMap, Counter, OrderedDict
 
 CLAUSE_KEYWORDS = ('select', 'from', 'where', 'group', 'order', 'limit', 'intersect', 'union', 'except')
 JOIN_KEYWORDS = ('join', 'on', 'as')
@@ -44,7 +48,41 @@ TABLE_TYPE = {
 COND_OPS = ('and', 'or')
 SQL_OPS = ('intersect', 'union', 'except')
 ORDER_OPS = ('desc', 'asc')
-mapped_entities = []
+
+# O(1) lookups for the hot parse loops: op name to id, and the tokens ending a clause or value
+WHERE_OP_IDS = {op: idx for idx, op in enumerate(WHERE_OPS)}
+UNIT_OP_IDS = {op: idx for idx, op in enumerate(UNIT_OPS)}
+AGG_OP_IDS = {op: idx for idx, op in enumerate(AGG_OPS)}
+CLAUSE_END_TOKENS = frozenset(CLAUSE_KEYWORDS + (")", ";"))
+CONDITION_END_TOKENS = CLAUSE_END_TOKENS | frozenset(JOIN_KEYWORDS)
+VALUE_END_TOKENS = frozenset(CLAUSE_KEYWORDS + JOIN_KEYWORDS + (',', ')', 'and'))
+CLAUSE_KEYWORD_SET = frozenset(CLAUSE_KEYWORDS)
+
+# Lexer reproducing nltk.word_tokenize on SQL, where quoted values are single
+# tokens. Matches runs of ',' / ':' with the word after them, chars nltk always
+# splits off, ',' and ':' unless followed by a digit, '--', runs of '.', pairs
+# of '`', and words (anything else, including quoted values) between them
+_SPLIT_CHARS = "()\\[\\]{}<>;@#$%&?!*\u00ab\u201c\u2018\u201e\u00bb\u201d\u2019\u2012-\u2015"
+_WORD = r'(?:"[^"]*"|[^\s"`:,.\-' + _SPLIT_CHARS + r']|[:,](?=\d)|-(?!-)|\.(?!\.))+'
+TOKEN_RE = re.compile(
+    r'([:,]{2,})(' + _WORD + r')?'
+    r'|(--|\.{2,}|``|`|[:,](?!\d)|[' + _SPLIT_CHARS + r'])'
+    r'|(' + _WORD + r')'
+)
+VALUE_RE = re.compile(r'"[^"]*"')
+# nltk splits a final period, optionally followed by closing brackets and spaces, from the word before it
+FINAL_PERIOD_RE = re.compile(r'(?<=[^.])\.[\])}> \u00bb\u201d\u2019]*\s*$')
+# Contractions nltk splits, e.g. 'cannot' to 'can', 'not'
+CONTRACTION_HINT_RE = re.compile(r'cannot|gimme|gonna|gotta|lemme|wanna')
+CONTRACTION_RES = [re.compile(pattern) for pattern in (
+    r'\b(can)(not)\b', r'\b(gim)(me)\b', r'\b(gon)(na)\b', r'\b(got)(ta)\b', r'\b(lem)(me)\b', r'\b(wan)(na)$')]
+COMPARISON_PREFIXES = ('!', '>', '<')
+
+DEFAULT_CACHE_SIZE = 100000
+CACHE_WRITE_BATCH_SIZE = 1000
+# Part of every cache key, bump when parse output changes so stored results are not reused
+PARSE_CACHE_VERSION = 1
+MISSING = object()
 
 
 class Schema:
@@ -78,6 +116,85 @@ class Schema:
         return idMap
 
 
+def schema_fingerprint(schema):
+    """Hash of a schema's tables, columns and ids, for keying parse results"""
+    text = json.dumps([schema.schema, schema.idMap], sort_keys=True)
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def cache_key(*parts):
+    return hashlib.blake2b('\0'.join([str(PARSE_CACHE_VERSION)] + list(parts)).encode('utf-8'), digest_size=16).hexdigest()
+
+
+class ParseCache:
+    """
+    Bounded LRU cache of parse results by cache_key, optionally backed by a
+    sqlite file which persists across runs. Cached results are shared, so
+    callers must not modify them. New results are written to the file in
+    batches, each in one short transaction, so processes sharing the file
+    don't hold its write lock while they parse.
+    """
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, db_path=None, stats=None):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.stats = stats if stats is not None else Counter()
+        self.pending = {}
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, timeout=60)
+            self.db.execute("CREATE TABLE IF NOT EXISTS parsed (key TEXT PRIMARY KEY, value BLOB)")
+
+    def get(self, key):
+        value = self.entries.get(key, MISSING)
+        if value is not MISSING:
+            self.entries.move_to_end(key)
+            self.stats['cache_hits'] += 1
+            return value
+
+        if self.db:
+            value = self.pending.get(key, MISSING)
+            if value is MISSING:
+                row = self.db.execute("SELECT value FROM parsed WHERE key = ?", (key,)).fetchone()
+                if row:
+                    value = pickle.loads(row[0])
+            if value is not MISSING:
+                self.stats['cache_store_hits'] += 1
+                self._remember(key, value)
+                return value
+
+        self.stats['cache_misses'] += 1
+        return MISSING
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.db:
+            self.pending[key] = value
+            if len(self.pending) >= CACHE_WRITE_BATCH_SIZE:
+                self.flush()
+
+    def _remember(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = value
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.stats['cache_evictions'] += 1
+
+    def flush(self):
+        if self.db and self.pending:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO parsed (key, value) VALUES (?, ?)",
+                                    ((key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+                                     for key, value in self.pending.items()))
+            self.pending = {}
+
+    def close(self):
+        if self.db:
+            self.flush()
+            self.db.close()
+            self.db = None
+
+
 def get_schema(db):
     """
     Get database's schema, which is a dict with table name as key
@@ -116,38 +233,148 @@ def get_schema_from_json(fpath):
 
 
 def tokenize(string):
+    return [tok for tok, _, _ in tokenize_with_offsets(string)]
+
+
+def tokenize_with_offsets(string):
+    """
+    Lowercased SQL tokens, with quoted values kept as single tokens wrapped in
+    double quotes, as (token, start, end) with offsets into string.
+    Single pass equivalent of running nltk.word_tokenize with quoted values
+    replaced by placeholders, then joining !=, >= and <=.
+    """
     string = str(string)
-    string = string.replace("\'\"","\"")
-    string = string.replace("\"\'","\"")
-    string = string.replace("\'", "\"")  # ensures all string values wrapped by "" problem??
-    quote_idxs = [idx for idx, char in enumerate(string) if char == '"']
-    assert len(quote_idxs) % 2 == 0, "Unexpected quote"
-
-    # keep string value as token
-    vals = {}
-    for i in range(len(quote_idxs)-1, -1, -2):
-        qidx1 = quote_idxs[i-1]
-        qidx2 = quote_idxs[i]
-        val = string[qidx1: qidx2+1]
-        key = "__val_{}_{}__".format(qidx1, qidx2)
-        string = string[:qidx1] + key + string[qidx2+1:]
-        vals[key] = val
-
-    toks = [word.lower() for word in word_tokenize(string)]
-    # replace with string value token
-    for i in range(len(toks)):
-        if toks[i] in vals:
-            toks[i] = vals[toks[i]]
-
-    # find if there exists !=, >=, <=
-    eq_idxs = [idx for idx, tok in enumerate(toks) if tok == "="]
-    eq_idxs.reverse()
-    prefix = ('!', '>', '<')
-    for eq_idx in eq_idxs:
-        pre_tok = toks[eq_idx-1]
-        if pre_tok in prefix:
-            toks = toks[:eq_idx-1] + [pre_tok + "="] + toks[eq_idx+1: ]
+    normalized, positions = normalize_quotes(string)
+    assert normalized.count('"') % 2 == 0, "Unexpected quote"
+
+    match = FINAL_PERIOD_RE.search(normalized) if '.' in normalized else None
+    final_period = match.start() if match else -1
+
+    toks = []
+    for match in TOKEN_RE.finditer(normalized):
+        commas, following, punct, word = match.groups()
+        if punct:
+            add_token(toks, punct, match.start(), match.end())
+        elif word:
+            start, end = match.span()
+            text = word.lower()
+            if '"' in word or end - 1 == final_period or text == '=' or CONTRACTION_HINT_RE.search(text):
+                add_word(toks, word, start, final_period)
+            else:
+                toks.append((text, start, end))
+        else:
+            split_commas(toks, commas, following or '', match.start(), final_period)
+
+    if positions is None:
+        return toks
+    return [(tok, positions[start], positions[end - 1] + 1) for tok, start, end in toks]
+
+
+def add_token(toks, tok, start, end):
+    if tok == '=' and toks and toks[-1][0] in COMPARISON_PREFIXES:
+        pre_tok, start, _ = toks.pop()
+        tok = pre_tok + '='
+    toks.append((tok, start, end))
+
+
+def add_word(toks, word, start, final_period):
+    end = start + len(word)
+    period = end - 1 == final_period
+    if period:
+        word = word[:-1]
+        end -= 1
+
+    if word[:1] == '"' and word.find('"', 1) == len(word) - 1:
+        toks.append((word, start, end))  # a single quoted value
+    elif word:
+        if '"' in word:
+            # values merged with other text are left as placeholders
+            word = VALUE_RE.sub(lambda m: "__val_{}_{}__".format(start + m.start(), start + m.end() - 1), word)
+        text = word.lower()
+        if CONTRACTION_HINT_RE.search(text):
+            parts = split_contractions(text, start, end)
+            add_token(toks, *parts[0])
+            toks.extend(parts[1:])
+        else:
+            add_token(toks, text, start, end)
+
+    if period:
+        toks.append(('.', end, end + 1))
+
+
+def split_commas(toks, commas, following, start, final_period):
+    """
+    nltk splits ',' and ':' along with the char after them when that is not a
+    digit. The char after is then not split itself, and sticks to what follows.
+    """
+    idx = 0
+    attached_start = None
+    while idx < len(commas):
+        next_char = commas[idx+1] if idx + 1 < len(commas) else following[:1]
+        if next_char.isdecimal():
+            if attached_start is None:
+                attached_start = idx
+            idx += 1
+            continue
 
+        if attached_start is not None:
+            toks.append((commas[attached_start:idx], start + attached_start, start + idx))
+        toks.append((commas[idx], start + idx, start + idx + 1))
+        attached_start = idx + 1 if idx + 1 < len(commas) else None
+        idx += 2
+
+    if attached_start is None:
+        if following:
+            add_word(toks, following, start + len(commas), final_period)
+    else:
+        add_word(toks, commas[attached_start:] + following, start + attached_start, final_period)
+
+
+def normalize_quotes(string):
+    """
+    Wrap all string values in double quotes the way the Spider tokenizer does.
+    :returns normalized string, and for each of its chars the index in string,
+    or None if indexes didn't change
+    """
+    if "\'\"" not in string and "\"\'" not in string:
+        return string.replace("\'", "\""), None
+
+    chars = list(string)
+    positions = list(range(len(string)))
+    for pair, keep in (("\'\"", 1), ("\"\'", 0)):
+        new_chars = []
+        new_positions = []
+        idx = 0
+        while idx < len(chars):
+            if chars[idx] == pair[0] and idx + 1 < len(chars) and chars[idx+1] == pair[1]:
+                new_chars.append('"')
+                new_positions.append(positions[idx+keep])
+                idx += 2
+            else:
+                new_chars.append(chars[idx])
+                new_positions.append(positions[idx])
+                idx += 1
+        chars, positions = new_chars, new_positions
+
+    return ''.join(chars).replace("\'", "\""), positions
+
+
+def split_contractions(text, start, end):
+    """
+    :returns (token, start, end) for parts of text, all spanning start to end
+    if text has value placeholders and isn't the same length as the source
+    """
+    same_length = len(text) == end - start
+    for contraction_re in CONTRACTION_RES:
+        text = contraction_re.sub(r' \1 \2 ', text)
+    toks = []
+    tok_start = start
+    for tok in text.split():
+        if same_length:
+            toks.append((tok, tok_start, tok_start + len(tok)))
+            tok_start += len(tok)
+        else:
+            toks.append((tok, start, end))
     return toks
 
 
@@ -168,11 +395,29 @@ def get_tables_with_alias(schema, toks):
     return tables
 
 
-def parse_col(toks, start_idx, tables_with_alias, schema, default_tables=None):
+class TokenView:
+    """
+    The tokens before end, without copying them
+    """
+    __slots__ = ('toks', 'end')
+
+    def __init__(self, toks, end):
+        self.toks = toks
+        self.end = end
+
+    def __len__(self):
+        return self.end
+
+    def __getitem__(self, idx):
+        if idx >= self.end:
+            raise IndexError("token index out of range")
+        return self.toks[idx]
+
+
+def parse_col(toks, start_idx, tables_with_alias, schema, default_tables=None, mapped_entities=None):
     """
         :returns next idx, column id
     """
-    global mapped_entities
     tok = toks[start_idx]
     if tok == "*":
         return start_idx + 1, schema.idMap[tok]
@@ -180,7 +425,8 @@ def parse_col(toks, start_idx, tables_with_alias, schema, default_tables=None):
     if '.' in tok:  # if token is a composite
         alias, col = tok.split('.')
         key = tables_with_alias[alias] + "." + col
-        mapped_entities.append((start_idx, tables_with_alias[alias] + "@" + col))
+        if mapped_entities is not None:
+            mapped_entities.append((start_idx, tables_with_alias[alias] + "@" + col))
         return start_idx+1, schema.idMap[key]
 
     assert default_tables is not None and len(default_tables) > 0, "Default tables should not be None or empty"
@@ -189,13 +435,14 @@ def parse_col(toks, start_idx, tables_with_alias, schema, default_tables=None):
         table = tables_with_alias[alias]
         if tok in schema.schema[table]:
             key = table + "." + tok
-            mapped_entities.append((start_idx, table + "@" + tok))
+            if mapped_entities is not None:
+                mapped_entities.append((start_idx, table + "@" + tok))
             return start_idx+1, schema.idMap[key]
 
     assert False, "Error col: {}".format(tok)
 
 
-def parse_col_unit(toks, start_idx, tables_with_alias, schema, default_tables=None):
+def parse_col_unit(toks, start_idx, tables_with_alias, schema, default_tables=None, mapped_entities=None):
     """
         :returns next idx, (agg_op id, col_id)
     """
@@ -207,15 +454,15 @@ def parse_col_unit(toks, start_idx, tables_with_alias, schema, default_tables=No
         isBlock = True
         idx += 1
 
-    if toks[idx] in AGG_OPS:
-        agg_id = AGG_OPS.index(toks[idx])
+    agg_id = AGG_OP_IDS.get(toks[idx])
+    if agg_id is not None:
         idx += 1
         assert idx < len_ and toks[idx] == '('
         idx += 1
         if toks[idx] == "distinct":
             idx += 1
             isDistinct = True
-        idx, col_id = parse_col(toks, idx, tables_with_alias, schema, default_tables)
+        idx, col_id = parse_col(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
         assert idx < len_ and toks[idx] == ')'
         idx += 1
         return idx, (agg_id, col_id, isDistinct)
@@ -223,8 +470,8 @@ def parse_col_unit(toks, start_idx, tables_with_alias, schema, default_tables=No
     if toks[idx] == "distinct":
         idx += 1
         isDistinct = True
-    agg_id = AGG_OPS.index("none")
-    idx, col_id = parse_col(toks, idx, tables_with_alias, schema, default_tables)
+    agg_id = AGG_OP_IDS['none']
+    idx, col_id = parse_col(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
 
     if isBlock:
         assert toks[idx] == ')'
@@ -233,7 +480,7 @@ def parse_col_unit(toks, start_idx, tables_with_alias, schema, default_tables=No
     return idx, (agg_id, col_id, isDistinct)
 
 
-def parse_val_unit(toks, start_idx, tables_with_alias, schema, default_tables=None):
+def parse_val_unit(toks, start_idx, tables_with_alias, schema, default_tables=None, mapped_entities=None):
     idx = start_idx
     len_ = len(toks)
     isBlock = False
@@ -243,13 +490,13 @@ def parse_val_unit(toks, start_idx, tables_with_alias, schema, default_tables=No
 
     col_unit1 = None
     col_unit2 = None
-    unit_op = UNIT_OPS.index('none')
+    unit_op = UNIT_OP_IDS['none']
 
-    idx, col_unit1 = parse_col_unit(toks, idx, tables_with_alias, schema, default_tables)
-    if idx < len_ and toks[idx] in UNIT_OPS:
-        unit_op = UNIT_OPS.index(toks[idx])
+    idx, col_unit1 = parse_col_unit(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
+    if idx < len_ and toks[idx] in UNIT_OP_IDS:
+        unit_op = UNIT_OP_IDS[toks[idx]]
         idx += 1
-        idx, col_unit2 = parse_col_unit(toks, idx, tables_with_alias, schema, default_tables)
+        idx, col_unit2 = parse_col_unit(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
 
     if isBlock:
         assert toks[idx] == ')'
@@ -274,7 +521,7 @@ def parse_table_unit(toks, start_idx, tables_with_alias, schema):
     return idx, schema.idMap[key], key
 
 
-def parse_value(toks, start_idx, tables_with_alias, schema, default_tables=None):
+def parse_value(toks, start_idx, tables_with_alias, schema, default_tables=None, mapped_entities=None):
     idx = start_idx
     len_ = len(toks)
 
@@ -289,7 +536,7 @@ def parse_value(toks, start_idx, tables_with_alias, schema, default_tables=None)
         toks[idx] = '"true"'
 
     if toks[idx] == 'select':
-        idx, val = parse_sql(toks, idx, tables_with_alias, schema)
+        idx, val = parse_sql(toks, idx, tables_with_alias, schema, mapped_entities=mapped_entities)
     elif "\"" in toks[idx]:  # token is a string value
         val = toks[idx]
         idx += 1
@@ -299,11 +546,10 @@ def parse_value(toks, start_idx, tables_with_alias, schema, default_tables=None)
             idx += 1
         except:
             end_idx = idx
-            while end_idx < len_ and toks[end_idx] != ',' and toks[end_idx] != ')'\
-                and toks[end_idx] != 'and' and toks[end_idx] not in CLAUSE_KEYWORDS and toks[end_idx] not in JOIN_KEYWORDS:
-                    end_idx += 1
+            while end_idx < len_ and toks[end_idx] not in VALUE_END_TOKENS:
+                end_idx += 1
 
-            idx, val = parse_col_unit(toks[: end_idx], start_idx, tables_with_alias, schema, default_tables)
+            idx, val = parse_col_unit(TokenView(toks, end_idx), start_idx, tables_with_alias, schema, default_tables, mapped_entities)
             idx = end_idx
 
     if isBlock:
@@ -313,34 +559,34 @@ def parse_value(toks, start_idx, tables_with_alias, schema, default_tables=None)
     return idx, val
 
 
-def parse_condition(toks, start_idx, tables_with_alias, schema, default_tables=None):
+def parse_condition(toks, start_idx, tables_with_alias, schema, default_tables=None, mapped_entities=None):
     idx = start_idx
     len_ = len(toks)
     conds = []
 
     while idx < len_:
-        idx, val_unit = parse_val_unit(toks, idx, tables_with_alias, schema, default_tables)
+        idx, val_unit = parse_val_unit(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
         not_op = False
         if toks[idx] == 'not':
             not_op = True
             idx += 1
 
-        assert idx < len_ and toks[idx] in WHERE_OPS, "Error condition: idx: {}, tok: {}".format(idx, toks[idx])
-        op_id = WHERE_OPS.index(toks[idx])
+        assert idx < len_ and toks[idx] in WHERE_OP_IDS, "Error condition: idx: {}, tok: {}".format(idx, toks[idx])
+        op_id = WHERE_OP_IDS[toks[idx]]
         idx += 1
         val1 = val2 = None
-        if op_id == WHERE_OPS.index('between'):  # between..and... special case: dual values
-            idx, val1 = parse_value(toks, idx, tables_with_alias, schema, default_tables)
+        if op_id == WHERE_OP_IDS['between']:  # between..and... special case: dual values
+            idx, val1 = parse_value(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
             assert toks[idx] == 'and'
             idx += 1
-            idx, val2 = parse_value(toks, idx, tables_with_alias, schema, default_tables)
+            idx, val2 = parse_value(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
         else:  # normal case: single value
-            idx, val1 = parse_value(toks, idx, tables_with_alias, schema, default_tables)
+            idx, val1 = parse_value(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
             val2 = None
 
         conds.append((not_op, op_id, val_unit, val1, val2))
 
-        if idx < len_ and (toks[idx] in CLAUSE_KEYWORDS or toks[idx] in (")", ";") or toks[idx] in JOIN_KEYWORDS):
+        if idx < len_ and toks[idx] in CONDITION_END_TOKENS:
             break
 
         if idx < len_ and toks[idx] in COND_OPS:
@@ -350,7 +596,7 @@ def parse_condition(toks, start_idx, tables_with_alias, schema, default_tables=N
     return idx, conds
 
 
-def parse_select(toks, start_idx, tables_with_alias, schema, default_tables=None):
+def parse_select(toks, start_idx, tables_with_alias, schema, default_tables=None, mapped_entities=None):
     idx = start_idx
     len_ = len(toks)
 
@@ -362,12 +608,13 @@ def parse_select(toks, start_idx, tables_with_alias, schema, default_tables=None
         isDistinct = True
     val_units = []
 
-    while idx < len_ and toks[idx] not in CLAUSE_KEYWORDS:
-        agg_id = AGG_OPS.index("none")
-        if toks[idx] in AGG_OPS:
-            agg_id = AGG_OPS.index(toks[idx])
+    while idx < len_ and toks[idx] not in CLAUSE_KEYWORD_SET:
+        agg_id = AGG_OP_IDS.get(toks[idx])
+        if agg_id is None:
+            agg_id = AGG_OP_IDS['none']
+        else:
             idx += 1
-        idx, val_unit = parse_val_unit(toks, idx, tables_with_alias, schema, default_tables)
+        idx, val_unit = parse_val_unit(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
         val_units.append((agg_id, val_unit))
         if idx < len_ and toks[idx] == ',':
             idx += 1  # skip ','
@@ -375,14 +622,16 @@ def parse_select(toks, start_idx, tables_with_alias, schema, default_tables=None
     return idx, (isDistinct, val_units)
 
 
-def parse_from(toks, start_idx, tables_with_alias, schema):
+def parse_from(toks, start_idx, tables_with_alias, schema, mapped_entities=None):
     """
     Assume in the from clause, all table units are combined with join
     """
-    assert 'from' in toks[start_idx:], "'from' not found"
+    try:
+        idx = toks.index('from', start_idx) + 1
+    except ValueError:
+        raise AssertionError("'from' not found")
 
     len_ = len(toks)
-    idx = toks.index('from', start_idx) + 1
     default_tables = []
     table_units = []
     conds = []
@@ -394,7 +643,7 @@ def parse_from(toks, start_idx, tables_with_alias, schema):
             idx += 1
 
         if toks[idx] == 'select':
-            idx, sql = parse_sql(toks, idx, tables_with_alias, schema)
+            idx, sql = parse_sql(toks, idx, tables_with_alias, schema, mapped_entities=mapped_entities)
             table_units.append((TABLE_TYPE['sql'], sql))
         else:
             if idx < len_ and toks[idx] == 'join':
@@ -404,7 +653,7 @@ def parse_from(toks, start_idx, tables_with_alias, schema):
             default_tables.append(table_name)
         if idx < len_ and toks[idx] == "on":
             idx += 1  # skip on
-            idx, this_conds = parse_condition(toks, idx, tables_with_alias, schema, default_tables)
+            idx, this_conds = parse_condition(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
             if len(conds) > 0:
                 conds.append('and')
             conds.extend(this_conds)
@@ -412,13 +661,13 @@ def parse_from(toks, start_idx, tables_with_alias, schema):
         if isBlock:
             assert toks[idx] == ')'
             idx += 1
-        if idx < len_ and (toks[idx] in CLAUSE_KEYWORDS or toks[idx] in (")", ";")):
+        if idx < len_ and toks[idx] in CLAUSE_END_TOKENS:
             break
 
     return idx, table_units, conds, default_tables
 
 
-def parse_where(toks, start_idx, tables_with_alias, schema, default_tables):
+def parse_where(toks, start_idx, tables_with_alias, schema, default_tables, mapped_entities=None):
     idx = start_idx
     len_ = len(toks)
 
@@ -426,11 +675,11 @@ def parse_where(toks, start_idx, tables_with_alias, schema, default_tables):
         return idx, []
 
     idx += 1
-    idx, conds = parse_condition(toks, idx, tables_with_alias, schema, default_tables)
+    idx, conds = parse_condition(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
     return idx, conds
 
 
-def parse_group_by(toks, start_idx, tables_with_alias, schema, default_tables):
+def parse_group_by(toks, start_idx, tables_with_alias, schema, default_tables, mapped_entities=None):
     idx = start_idx
     len_ = len(toks)
     col_units = []
@@ -442,8 +691,8 @@ def parse_group_by(toks, start_idx, tables_with_alias, schema, default_tables):
     assert toks[idx] == 'by'
     idx += 1
 
-    while idx < len_ and not (toks[idx] in CLAUSE_KEYWORDS or toks[idx] in (")", ";")):
-        idx, col_unit = parse_col_unit(toks, idx, tables_with_alias, schema, default_tables)
+    while idx < len_ and toks[idx] not in CLAUSE_END_TOKENS:
+        idx, col_unit = parse_col_unit(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
         col_units.append(col_unit)
         if idx < len_ and toks[idx] == ',':
             idx += 1  # skip ','
@@ -453,7 +702,7 @@ def parse_group_by(toks, start_idx, tables_with_alias, schema, default_tables):
     return idx, col_units
 
 
-def parse_order_by(toks, start_idx, tables_with_alias, schema, default_tables):
+def parse_order_by(toks, start_idx, tables_with_alias, schema, default_tables, mapped_entities=None):
     idx = start_idx
     len_ = len(toks)
     val_units = []
@@ -466,8 +715,8 @@ def parse_order_by(toks, start_idx, tables_with_alias, schema, default_tables):
     assert toks[idx] == 'by'
     idx += 1
 
-    while idx < len_ and not (toks[idx] in CLAUSE_KEYWORDS or toks[idx] in (")", ";")):
-        idx, val_unit = parse_val_unit(toks, idx, tables_with_alias, schema, default_tables)
+    while idx < len_ and toks[idx] not in CLAUSE_END_TOKENS:
+        idx, val_unit = parse_val_unit(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
         val_units.append(val_unit)
         if idx < len_ and toks[idx] in ORDER_OPS:
             order_type = toks[idx]
@@ -480,7 +729,7 @@ def parse_order_by(toks, start_idx, tables_with_alias, schema, default_tables):
     return idx, (order_type, val_units)
 
 
-def parse_having(toks, start_idx, tables_with_alias, schema, default_tables):
+def parse_having(toks, start_idx, tables_with_alias, schema, default_tables, mapped_entities=None):
     idx = start_idx
     len_ = len(toks)
 
@@ -488,7 +737,7 @@ def parse_having(toks, start_idx, tables_with_alias, schema, default_tables):
         return idx, []
 
     idx += 1
-    idx, conds = parse_condition(toks, idx, tables_with_alias, schema, default_tables)
+    idx, conds = parse_condition(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
     return idx, conds
 
 
@@ -507,9 +756,13 @@ def parse_limit(toks, start_idx):
     return idx, None
 
 
-def parse_sql(toks, start_idx, tables_with_alias, schema, mapped_entities_fn=None):
-    global mapped_entities
-
+def parse_sql(toks, start_idx, tables_with_alias, schema, mapped_entities_fn=None, mapped_entities=None):
+    """
+    :param mapped_entities_fn: called for a new list to collect the column
+        references as (token idx, "table@column"), returned after the sql
+    :param mapped_entities: list the column references are appended to,
+        shared with nested queries
+    """
     if mapped_entities_fn is not None:
         mapped_entities = mapped_entities_fn()
     isBlock = False # indicate whether this is a block of sql/sub-sql
@@ -522,23 +775,23 @@ def parse_sql(toks, start_idx, tables_with_alias, schema, mapped_entities_fn=Non
         idx += 1
 
     # parse from clause in order to get default tables
-    from_end_idx, table_units, conds, default_tables = parse_from(toks, start_idx, tables_with_alias, schema)
+    from_end_idx, table_units, conds, default_tables = parse_from(toks, start_idx, tables_with_alias, schema, mapped_entities)
     sql['from'] = {'table_units': table_units, 'conds': conds}
     # select clause
-    _, select_col_units = parse_select(toks, idx, tables_with_alias, schema, default_tables)
+    _, select_col_units = parse_select(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
     idx = from_end_idx
     sql['select'] = select_col_units
     # where clause
-    idx, where_conds = parse_where(toks, idx, tables_with_alias, schema, default_tables)
+    idx, where_conds = parse_where(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
     sql['where'] = where_conds
     # group by clause
-    idx, group_col_units = parse_group_by(toks, idx, tables_with_alias, schema, default_tables)
+    idx, group_col_units = parse_group_by(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
     sql['groupBy'] = group_col_units
     # having clause
-    idx, having_conds = parse_having(toks, idx, tables_with_alias, schema, default_tables)
+    idx, having_conds = parse_having(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
     sql['having'] = having_conds
     # order by clause
-    idx, order_col_units = parse_order_by(toks, idx, tables_with_alias, schema, default_tables)
+    idx, order_col_units = parse_order_by(toks, idx, tables_with_alias, schema, default_tables, mapped_entities)
     sql['orderBy'] = order_col_units
     # limit clause
     idx, limit_val = parse_limit(toks, idx)
@@ -556,7 +809,7 @@ def parse_sql(toks, start_idx, tables_with_alias, schema, mapped_entities_fn=Non
     if idx < len_ and toks[idx] in SQL_OPS:
         sql_op = toks[idx]
         idx += 1
-        idx, IUE_sql = parse_sql(toks, idx, tables_with_alias, schema)
+        idx, IUE_sql = parse_sql(toks, idx, tables_with_alias, schema, mapped_entities=mapped_entities)
         sql[sql_op] = IUE_sql
 
     if mapped_entities_fn is not None:
@@ -572,11 +825,87 @@ def load_data(fpath):
 
 
 def get_sql(schema, query):
-    toks = tokenize(query)
-    tables_with_alias = get_tables_with_alias(schema.schema, toks)
-    _, sql = parse_sql(toks, 0, tables_with_alias, schema)
+    return SqlParser(schema).get_sql(query)
+
+
+class SqlParser:
+    """
+    Parses queries against one schema, building the schema lookups once.
+    Keeps no state between queries, so may be shared between threads unless
+    given a ParseCache, which get_sql then looks queries up in first.
+    """
+    def __init__(self, schema, cache=None):
+        self.schema = schema
+        self.tables = {key: key for key in schema.schema}
+        self.cache = cache
+        self.fingerprint = schema_fingerprint(schema) if cache is not None else None
+
+    def get_tables_with_alias(self, toks):
+        alias = scan_alias(toks)
+        for key in alias:
+            assert key not in self.tables, "Alias {} has the same name in table".format(key)
+        return ChainMap(alias, self.tables)
+
+    def get_sql(self, query):
+        if self.cache is not None:
+            key = cache_key('sql', self.fingerprint, query)
+            sql = self.cache.get(key)
+            if sql is not MISSING:
+                return sql
+
+        toks = tokenize(query)
+        tables_with_alias = self.get_tables_with_alias(toks)
+        _, sql = parse_sql(toks, 0, tables_with_alias, self.schema)
+
+        if self.cache is not None:
+            self.cache.put(key, sql)
+        return sql
+
+    def get_sql_with_entities(self, query):
+        """
+        :returns (sql, mapped entities) where the mapped entities are the
+        column references as (token idx, "table@column"), in parse order
+        """
+        toks = tokenize(query)
+        tables_with_alias = self.get_tables_with_alias(toks)
+        _, sql, mapped_entities = parse_sql(toks, 0, tables_with_alias, self.schema, mapped_entities_fn=list)
+
+        return sql, mapped_entities
+
+    def parse(self, query):
+        """
+        :returns (query, sql, error) where error is None, or the exception
+        raised parsing the query as "Type: message" and sql is None
+        """
+        try:
+            return query, self.get_sql(query), None
+        except Exception as e:
+            return query, None, "{}: {}".format(type(e).__name__, e)
+
+    def parse_many(self, queries, workers=None, chunksize=64):
+        """
+        Generator of parse() results for queries, in order. With workers > 1
+        queries are parsed in a process pool, each worker getting the schema once.
+        """
+        if workers is None or workers <= 1:
+            for query in queries:
+                yield self.parse(query)
+            return
+
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(self.schema,)) as pool:
+            yield from pool.imap(_parse_in_worker, queries, chunksize)
+
+
+_worker_parser = None
+
+
+def _init_worker(schema):
+    global _worker_parser
+    _worker_parser = SqlParser(schema)
+
 
-    return sql
+def _parse_in_worker(query):
+    return _worker_parser.parse(query)
 
 
 def skip_semicolon(toks, start_idx):
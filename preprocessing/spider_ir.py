@@ -0,0 +1,258 @@
+"""
+Compact in-memory form of Spider sql dicts, and streaming Spider JSON output
+"""
+
+import json
+from array import array
+from process_sql import COND_OPS, ORDER_OPS, SQL_OPS, TABLE_TYPE
+
+# Tags for the parts of a sql dict that may take several forms
+NO_COL_UNIT = -1
+COND_UNIT = 0  # 1 + COND_OPS index for 'and' / 'or'
+NONE_VALUE, SQL_VALUE, COL_UNIT_VALUE, SCALAR_VALUE = range(4)
+NO_ORDER_BY = -1
+TABLE_UNIT, SQL_TABLE_UNIT = range(2)
+
+class ColumnTable:
+  """
+  Interns the column and table ids of a schema to small ints, shared by all
+  the CompactSql of that schema
+  """
+  def __init__(self):
+    self.ids = []
+    self.index = {}
+
+  def intern(self, id):
+    idx = self.index.get(id)
+    if idx is None:
+      idx = self.index[id] = len(self.ids)
+      self.ids.append(id)
+    return idx
+
+class CompactSql:
+  """
+  A Spider sql dict flattened into an array of ints, in pre-order. Column and
+  table ids are indexes into a ColumnTable; strings, floats and other values
+  are kept in a tuple alongside.
+  """
+  __slots__ = ('codes', 'values', 'columns')
+
+  def __init__(self, codes, values, columns):
+    self.codes = codes
+    self.values = values
+    self.columns = columns
+
+  @classmethod
+  def from_spider(cls, sql, columns):
+    """
+    :param sql: sql dict as returned by process_sql.get_sql, or loaded from Spider JSON
+    :param columns: ColumnTable for the schema the sql was parsed with
+    """
+    encoder = _Encoder(columns)
+    encoder.sql(sql)
+    return cls(encoder.codes, tuple(encoder.values), columns)
+
+  def to_spider(self):
+    """The sql dict, equal to the one given to from_spider"""
+    return _Decoder(self).sql()
+
+  def __eq__(self, other):
+    return isinstance(other, CompactSql) and self.to_spider() == other.to_spider()
+
+  def __repr__(self):
+    return "CompactSql({!r})".format(self.to_spider())
+
+class _Encoder:
+  def __init__(self, columns):
+    self.columns = columns
+    self.codes = array('i')
+    self.values = []
+
+  def sql(self, sql):
+    codes = self.codes
+    is_distinct, val_units = sql['select']
+    codes.append(bool(is_distinct))
+    codes.append(len(val_units))
+    for agg_id, val_unit in val_units:
+      codes.append(agg_id)
+      self.val_unit(val_unit)
+
+    table_units = sql['from']['table_units']
+    codes.append(len(table_units))
+    for table_type, unit in table_units:
+      if table_type == TABLE_TYPE['sql']:
+        codes.append(SQL_TABLE_UNIT)
+        self.sql(unit)
+      else:
+        codes.append(TABLE_UNIT)
+        codes.append(self.columns.intern(unit))
+    self.condition(sql['from']['conds'])
+
+    self.condition(sql['where'])
+    codes.append(len(sql['groupBy']))
+    for col_unit in sql['groupBy']:
+      self.col_unit(col_unit)
+
+    if sql['orderBy']:
+      order_type, val_units = sql['orderBy']
+      codes.append(ORDER_OPS.index(order_type))
+      codes.append(len(val_units))
+      for val_unit in val_units:
+        self.val_unit(val_unit)
+    else:
+      codes.append(NO_ORDER_BY)
+
+    self.condition(sql['having'])
+    self.value(sql['limit'])
+    for op in SQL_OPS:
+      if sql[op] is None:
+        codes.append(0)
+      else:
+        codes.append(1)
+        self.sql(sql[op])
+
+  def col_unit(self, col_unit):
+    if col_unit is None:
+      self.codes.append(NO_COL_UNIT)
+      return
+    agg_id, col_id, is_distinct = col_unit
+    self.codes.extend((agg_id, self.columns.intern(col_id), bool(is_distinct)))
+
+  def val_unit(self, val_unit):
+    unit_op, col_unit1, col_unit2 = val_unit
+    self.codes.append(unit_op)
+    self.col_unit(col_unit1)
+    self.col_unit(col_unit2)
+
+  def condition(self, conds):
+    self.codes.append(len(conds))
+    for cond in conds:
+      if isinstance(cond, str):
+        self.codes.append(COND_UNIT + 1 + COND_OPS.index(cond))
+        continue
+      not_op, op_id, val_unit, val1, val2 = cond
+      self.codes.extend((COND_UNIT, bool(not_op), op_id))
+      self.val_unit(val_unit)
+      self.value(val1)
+      self.value(val2)
+
+  def value(self, val):
+    if val is None:
+      self.codes.append(NONE_VALUE)
+    elif isinstance(val, dict):
+      self.codes.append(SQL_VALUE)
+      self.sql(val)
+    elif isinstance(val, (tuple, list)):
+      self.codes.append(COL_UNIT_VALUE)
+      self.col_unit(val)
+    else:
+      self.codes.extend((SCALAR_VALUE, len(self.values)))
+      self.values.append(val)
+
+class _Decoder:
+  def __init__(self, compact):
+    self.codes = compact.codes
+    self.values = compact.values
+    self.ids = compact.columns.ids
+    self.idx = 0
+
+  def next(self):
+    code = self.codes[self.idx]
+    self.idx += 1
+    return code
+
+  def sql(self):
+    sql = {}
+    is_distinct = bool(self.next())
+    val_units = [(self.next(), self.val_unit()) for _ in range(self.next())]
+    select = (is_distinct, val_units)
+
+    table_units = []
+    for _ in range(self.next()):
+      if self.next() == SQL_TABLE_UNIT:
+        table_units.append((TABLE_TYPE['sql'], self.sql()))
+      else:
+        table_units.append((TABLE_TYPE['table_unit'], self.ids[self.next()]))
+    sql['from'] = {'table_units': table_units, 'conds': self.condition()}
+    sql['select'] = select
+
+    sql['where'] = self.condition()
+    sql['groupBy'] = [self.col_unit() for _ in range(self.next())]
+    order_type = self.next()
+    if order_type == NO_ORDER_BY:
+      order_by = []
+    else:
+      order_by = (ORDER_OPS[order_type], [self.val_unit() for _ in range(self.next())])
+    sql['having'] = self.condition()
+    sql['orderBy'] = order_by
+    sql['limit'] = self.value()
+    for op in SQL_OPS:
+      sql[op] = self.sql() if self.next() else None
+    return sql
+
+  def col_unit(self):
+    agg_id = self.next()
+    if agg_id == NO_COL_UNIT:
+      return None
+    return (agg_id, self.ids[self.next()], bool(self.next()))
+
+  def val_unit(self):
+    return (self.next(), self.col_unit(), self.col_unit())
+
+  def condition(self):
+    conds = []
+    for _ in range(self.next()):
+      tag = self.next()
+      if tag != COND_UNIT:
+        conds.append(COND_OPS[tag - COND_UNIT - 1])
+        continue
+      not_op = bool(self.next())
+      op_id = self.next()
+      conds.append((not_op, op_id, self.val_unit(), self.value(), self.value()))
+    return conds
+
+  def value(self):
+    tag = self.next()
+    if tag == NONE_VALUE:
+      return None
+    if tag == SQL_VALUE:
+      return self.sql()
+    if tag == COL_UNIT_VALUE:
+      return self.col_unit()
+    return self.values[self.next()]
+
+def _default(obj):
+  if isinstance(obj, CompactSql):
+    return obj.to_spider()
+  raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+class SpiderJsonWriter:
+  """
+  Writes a JSON array of Spider queries one query at a time, so they need not
+  all be held in memory. The output is the same as json.dump(queries,
+  sort_keys=True, indent=2, separators=(',', ': ')). With compact=True each
+  query is written on one line without indentation, which is much faster as
+  json can use its C encoder. CompactSql values are written as sql dicts.
+  """
+  def __init__(self, output_file, compact=False):
+    self.file = open(output_file, 'w')
+    self.compact = compact
+    self.count = 0
+
+  def write(self, query):
+    if self.compact:
+      text = json.dumps(query, sort_keys=True, default=_default)
+    else:
+      text = json.dumps(query, sort_keys=True, indent=2, separators=(',', ': '), default=_default).replace('\n', '\n  ')
+    self.file.write(("[\n  " if self.count == 0 else ",\n  ") + text)
+    self.count += 1
+
+  def close(self):
+    self.file.write("\n]" if self.count else "[]")
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
@@ -0,0 +1,179 @@
+"""
+Builds Spider tables json from SQLite databases - column names and types,
+primary keys and foreign keys, read from the databases themselves.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import re
+import sqlite3
+from gml_csv_2_spider_schema_json import clean_column_table_names, clean_column_table_name
+
+TYPE_ARGS_RE = re.compile(r'\(.*\)')
+
+def sqlite_column_type(type):
+  """Spider column type of a declared SQLite column type, matched by substring as SQLite derives type affinity"""
+  type_text = TYPE_ARGS_RE.sub('', type).strip().lower()
+  if 'bool' in type_text:
+    return "boolean"
+  if 'date' in type_text or 'time' in type_text:
+    return "time"
+  if 'char' in type_text or 'clob' in type_text or 'text' in type_text or not type_text:
+    return "text"
+  if any(name in type_text for name in ('int', 'real', 'floa', 'doub', 'numeric', 'decimal', 'number')):
+    return "number"
+  return "text"
+
+def get_spider_tables(sqlite_file, db_id=None):
+  """
+  Spider tables json entry of a database, read over a single read-only
+  connection. Foreign keys are [column index, referenced column index].
+  :param db_id: defaults to the file name without extension
+  """
+  conn = sqlite3.connect(Path(sqlite_file).resolve().as_uri() + '?mode=ro', uri=True)
+  try:
+    tables = [name for name, in conn.execute(
+      "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY rowid")]
+    table_columns = [conn.execute(f"PRAGMA table_info({quote(table)})").fetchall() for table in tables]
+    table_foreign_keys = [conn.execute(f"PRAGMA foreign_key_list({quote(table)})").fetchall() for table in tables]
+  finally:
+    conn.close()
+
+  new_table = {
+    "column_names": [[-1, "*"]],
+    "column_names_original": [[-1, "*"]],
+    "column_types": ['text'],
+    "primary_keys": [],
+    "foreign_keys": [],
+    "table_names_original": tables,
+    "table_names": clean_column_table_names(tables),
+    "db_id": db_id or Path(sqlite_file).stem,
+  }
+  # SQLite names are case insensitive, so foreign keys are resolved by lowercased name
+  column_index = {}
+  primary_keys = {}
+  for table_counter, (table, columns) in enumerate(zip(tables, table_columns)):
+    for _, col, type, _, _, pk in columns:
+      col_counter = len(new_table["column_names_original"])
+      column_index[(table.lower(), col.lower())] = col_counter
+      new_table["column_names_original"].append([table_counter, col])
+      new_table["column_names"].append([table_counter, clean_column_table_name(col)])
+      new_table["column_types"].append(sqlite_column_type(type))
+      if pk:
+        new_table["primary_keys"].append(col_counter)
+        primary_keys.setdefault(table.lower(), []).append((pk, col_counter))
+
+  seen = set()
+  for table, foreign_keys in zip(tables, table_foreign_keys):
+    # a foreign key of several columns has a row per column, with the same id
+    for _, seq, ref_table, col, ref_col, *_ in foreign_keys:
+      from_idx = column_index.get((table.lower(), col.lower()))
+      if ref_col is None:
+        # references the primary key of ref_table
+        ref_pks = sorted(primary_keys.get(ref_table.lower(), []))
+        to_idx = ref_pks[seq][1] if seq < len(ref_pks) else None
+      else:
+        to_idx = column_index.get((ref_table.lower(), ref_col.lower()))
+      if from_idx is None or to_idx is None or (from_idx, to_idx) in seen:
+        continue
+      seen.add((from_idx, to_idx))
+      new_table["foreign_keys"].append([from_idx, to_idx])
+  return new_table
+
+def quote(name):
+  return '"{}"'.format(name.replace('"', '""'))
+
+def find_sqlite_files(paths):
+  """The files given, and the .sqlite files under the directories given, in sorted order"""
+  sqlite_files = []
+  for path in paths:
+    if os.path.isdir(path):
+      sqlite_files.extend(sorted(str(p) for p in Path(path).rglob('*.sqlite')))
+    else:
+      sqlite_files.append(path)
+  return sqlite_files
+
+class TablesCache:
+  """
+  Tables json entries of databases, kept in a json file between runs. An
+  entry is reused while the database file has the same mtime and size.
+  """
+  def __init__(self, path):
+    self.path = path
+    self.entries = {}
+    self.stats = {'cache_hits': 0, 'cache_misses': 0}
+    if path and os.path.exists(path):
+      with open(path) as f:
+        self.entries = json.load(f)
+
+  def get(self, sqlite_file):
+    entry = self.entries.get(os.path.abspath(sqlite_file))
+    if entry is not None and entry['signature'] == file_signature(sqlite_file):
+      self.stats['cache_hits'] += 1
+      return entry['tables']
+    self.stats['cache_misses'] += 1
+    return None
+
+  def put(self, sqlite_file, signature, tables):
+    self.entries[os.path.abspath(sqlite_file)] = {'signature': signature, 'tables': tables}
+
+  def save(self):
+    if not self.path:
+      return
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(self.entries, f)
+    os.replace(tmp_path, self.path)
+
+def file_signature(path):
+  stat = os.stat(path)
+  return [stat.st_mtime_ns, stat.st_size]
+
+def _read_tables(sqlite_file):
+  # the signature is taken before reading, so a database changed meanwhile is read again next time
+  signature = file_signature(sqlite_file)
+  return signature, get_spider_tables(sqlite_file)
+
+def sqlite_to_spider_tables(sqlite_files, cache_file=None, workers=None):
+  """
+  :returns tables json entries of the databases, in the order given
+  :param workers: processes reading databases in parallel; None reads them in this process
+  """
+  cache = TablesCache(cache_file)
+  all_tables = [cache.get(sqlite_file) for sqlite_file in sqlite_files]
+  misses = [sqlite_file for sqlite_file, tables in zip(sqlite_files, all_tables) if tables is None]
+
+  if workers is not None and workers > 1 and len(misses) > 1:
+    with multiprocessing.Pool(workers) as pool:
+      results = pool.map(_read_tables, misses, chunksize=max(1, len(misses) // (workers * 4)))
+  else:
+    results = [_read_tables(sqlite_file) for sqlite_file in misses]
+
+  results = iter(zip(misses, results))
+  for idx, tables in enumerate(all_tables):
+    if tables is None:
+      sqlite_file, (signature, tables) = next(results)
+      cache.put(sqlite_file, signature, tables)
+      all_tables[idx] = tables
+  cache.save()
+  print("Read {} databases, {} from cache".format(len(misses), cache.stats['cache_hits']))
+  return all_tables
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--input', '-i', dest='inputs', type=str, nargs='+', required=True, help='SQLite files, or directories searched for .sqlite files. db_id is the file name without extension')
+  parser.add_argument('--output-file', '-o', dest='output_file', type=str, required=True, help='Spider tables json file to write')
+  parser.add_argument('--workers', '-w', dest='workers', type=int, default=None, help='Processes reading databases in parallel; default=read in this process')
+  parser.add_argument('--cache-file', dest='cache_file', type=str, default=None, help='JSON file keeping tables read, reused for databases whose mtime and size are unchanged')
+  args = parser.parse_args()
+
+  all_tables = sqlite_to_spider_tables(find_sqlite_files(args.inputs), args.cache_file, args.workers)
+  print(f"Writing tables json file:        {args.output_file}")
+  with open(args.output_file, 'w') as f:
+    json.dump(all_tables, f, indent=2)
+
+# Example usage -
+# python sqlite_to_spider_tables.py -i spider/database -o tables.json -w 8 --cache-file tables_cache.json
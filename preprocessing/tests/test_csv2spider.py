@@ -0,0 +1,122 @@
+import json
+import pytest
+from .. import csv2spider
+
+TABLES = [{
+  "db_id": "concert_singer",
+  "table_names_original": ["singer", "concert"],
+  "column_names_original": [[-1, "*"], [0, "singer_id"], [0, "name"], [0, "age"], [1, "concert_id"], [1, "singer_id"], [1, "year"]],
+  "column_types": ["text", "number", "text", "number", "number", "number", "number"],
+}, {
+  "db_id": "pets",
+  "table_names_original": ["pets"],
+  "column_names_original": [[-1, "*"], [0, "pet_id"], [0, "pet_type"], [0, "weight"]],
+  "column_types": ["text", "number", "text", "number"],
+}]
+
+ROWS = [
+  ("SELECT name FROM singer WHERE age > 30", "Which singers are older than 30?"),
+  ("SELECT name FROM singer WHERE age > 30", "Names of singers over 30"),
+  ("SELECT T1.name FROM singer AS T1 JOIN concert AS T2 ON T1.singer_id = T2.singer_id WHERE T2.year = 2014", "Who sang in 2014?"),
+  ("SELECT count(*) FROM concert", ""),
+  ("SELECT name FROM singer WHERE name = 'Joe'", "Is Joe a singer?"),
+]
+
+@pytest.fixture
+def dataset(tmp_path):
+  table_file = tmp_path / 'tables.json'
+  table_file.write_text(json.dumps(TABLES))
+  input_file = tmp_path / 'input.csv'
+  write_csv(input_file, ROWS)
+  return tmp_path, str(input_file), str(table_file)
+
+def write_csv(path, rows):
+  path.write_text("query,label\n" + "".join('"{}","{}"\n'.format(query, label) for query, label in rows))
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_process_streams_chunks(dataset, workers):
+  tmp_path, input_file, table_file = dataset
+  output_file = str(tmp_path / 'output.json')
+  csv2spider.process('concert_singer', input_file, table_file, False, output_file, chunk_size=2, workers=workers)
+
+  schemas, _, tables = csv2spider.get_schemas_from_json(table_file)
+  schema = csv2spider.Schema(schemas['concert_singer'], tables['concert_singer'])
+  query_texts, queries = csv2spider.process_csv(input_file, schema, 'concert_singer', output_file)
+  assert len(queries) == 4
+  with open(output_file) as f:
+    assert f.read() == json.dumps(queries, sort_keys=True, indent=2, separators=(',', ': '))
+  with open(tmp_path / 'output_gold.sql') as f:
+    assert f.read() == "".join("%s\tconcert_singer\n" % q for q in query_texts)
+
+@pytest.mark.parametrize('q, query, query_no_value', [
+  ("SELECT name FROM singer WHERE name = 'Joe' AND age > 3.5",
+   "SELECT name FROM singer WHERE name = 'Joe' AND age > 3.5",
+   "select name from singer where name = value and age > value"),
+  ('SELECT T1.Name FROM Singer AS T1 WHERE T1.country = "France" LIMIT 1; SELECT 2',
+   'SELECT T1.Name FROM Singer AS T1 WHERE T1.country = "France" LIMIT 1; ',
+   'select t1.name from singer as t1 where t1.country = value limit value; '),
+  ("SELECT `First Name` FROM p WHERE city = 'İstanbul' AND id IN (1, -2)",
+   "SELECT `First Name` FROM p WHERE city = 'İstanbul' AND id IN (1, -2)",
+   "select `first name` from p where city = value and id in (value, value)"),
+])
+def test_strip_values(q, query, query_no_value):
+  assert csv2spider.strip_values(q) == (query, query_no_value)
+
+def test_word_tokenize_without_nltk_data(monkeypatch):
+  monkeypatch.setattr(csv2spider, 'nltk_punkt_available', lambda: False)
+  assert csv2spider.word_tokenize("How many singers are older than 30?") == ['How', 'many', 'singers', 'are', 'older', 'than', '30', '?']
+  assert csv2spider.word_tokenize("select name from singer where name = value") == [
+    'select', 'name', 'from', 'singer', 'where', 'name', '=', 'value']
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_process_manifest(dataset, workers):
+  tmp_path, input_file, table_file = dataset
+  write_csv(tmp_path / 'pets.csv', [
+    ("SELECT count(*) FROM pets WHERE weight > 10", "How many pets weigh more than 10?"),
+    ("SELECT pet_type FROM pets", "List the pet types")])
+  (tmp_path / 'manifest.csv').write_text(
+    "db_id,input_file,output_file\n"
+    "concert_singer,input.csv,train.json\n"
+    "pets,pets.csv,train.json\n"
+    "pets,pets.csv,dev.json\n")
+  csv2spider.process_manifest(str(tmp_path / 'manifest.csv'), table_file, False, workers=workers)
+
+  schemas, _, tables = csv2spider.get_schemas_from_json(table_file)
+  converted = {}
+  for db_id, path in [('concert_singer', input_file), ('pets', str(tmp_path / 'pets.csv'))]:
+    schema = csv2spider.Schema(schemas[db_id], tables[db_id])
+    converted[db_id] = csv2spider.process_csv(path, schema, db_id, None)
+
+  for output_file, db_ids in [('train.json', ['concert_singer', 'pets']), ('dev.json', ['pets'])]:
+    queries = [query for db_id in db_ids for query in converted[db_id][1]]
+    with open(tmp_path / output_file) as f:
+      assert f.read() == json.dumps(queries, sort_keys=True, indent=2, separators=(',', ': '))
+    with open(tmp_path / output_file.replace('.json', '_gold.sql')) as f:
+      assert f.read() == "".join("%s\t%s\n" % (q, db_id) for db_id in db_ids for q in converted[db_id][0])
+
+def test_process_build_manifest(dataset, capsys):
+  tmp_path, input_file, table_file = dataset
+  output_file = str(tmp_path / 'output.json')
+  build_manifest = str(tmp_path / 'build.json')
+  csv2spider.process('concert_singer', input_file, table_file, False, output_file, build_manifest=build_manifest)
+  with open(output_file) as f:
+    expected = f.read()
+
+  # unchanged inputs are not converted again
+  capsys.readouterr()
+  csv2spider.process('concert_singer', input_file, table_file, False, output_file, build_manifest=build_manifest)
+  assert "Up to date: " + output_file in capsys.readouterr().out
+  with open(output_file) as f:
+    assert f.read() == expected
+
+  # a changed input rebuilds the output, parsing only its new queries
+  write_csv(tmp_path / 'input.csv', ROWS + [("SELECT year FROM concert", "Concert years")])
+  csv2spider.process('concert_singer', input_file, table_file, False, output_file, build_manifest=build_manifest)
+  assert "Parsed 1 distinct queries, 3 cache hits" in capsys.readouterr().out
+  with open(output_file) as f:
+    assert len(json.load(f)) == 5
+
+  # as does a changed option
+  csv2spider.process('concert_singer', input_file, table_file, False, output_file, compact_json=True,
+                     build_manifest=build_manifest)
+  assert "Up to date" not in capsys.readouterr().out
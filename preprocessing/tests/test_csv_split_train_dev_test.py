@@ -0,0 +1,49 @@
+import csv
+import pytest
+from .. import csv_split_train_dev_test
+
+def read_rows(path):
+  with open(path, newline='') as f:
+    return list(csv.reader(f))
+
+@pytest.fixture
+def input_file(tmp_path):
+  path = tmp_path / 'queries.csv'
+  with open(path, 'w', newline='') as f:
+    writer = csv.writer(f, lineterminator='\n')
+    writer.writerow(['query', 'label'])
+    for i in range(100):
+      writer.writerow([f"SELECT {i}", f"question\n{i}" if i % 10 == 0 else f"question {i}"])
+  return path
+
+def test_split(input_file, capsys):
+  csv_split_train_dev_test.main(str(input_file), 0.2, 10, seed=3)
+  rows = read_rows(input_file)
+  splits = {prefix: read_rows(input_file.parent / f'{prefix}_queries.csv') for prefix in ('dev', 'test', 'train')}
+  assert [len(split) - 1 for split in splits.values()] == [10, 20, 70]
+  assert all(split[0] == rows[0] for split in splits.values())
+  assert sorted(row for split in splits.values() for row in split[1:]) == sorted(rows[1:])
+  # line counts include values spanning lines
+  out = capsys.readouterr().out
+  dev_lines = sum(1 + row[1].count('\n') for row in splits['dev'])
+  assert "Wrote 10 records to {}, {} lines".format(input_file.parent / 'dev_queries.csv', dev_lines) in out
+
+  # the same seed gives the same split
+  csv_split_train_dev_test.main(str(input_file), 0.2, 10, seed=3)
+  assert read_rows(input_file.parent / 'dev_queries.csv') == splits['dev']
+  csv_split_train_dev_test.main(str(input_file), 0.2, 10, seed=4)
+  assert read_rows(input_file.parent / 'dev_queries.csv') != splits['dev']
+
+def test_split_without_dev_and_test(input_file):
+  csv_split_train_dev_test.main(str(input_file), 0, 0, seed=1)
+  assert read_rows(input_file.parent / 'train_queries.csv') == read_rows(input_file)
+  assert not (input_file.parent / 'dev_queries.csv').exists()
+
+def test_assign_splits_uniform():
+  counts = [[0, 0, 0] for _ in range(6)]
+  for seed in range(3000):
+    for record, split in enumerate(csv_split_train_dev_test.assign_splits((1, 2, 3), 6, seed)):
+      counts[record][split] += 1
+  # every record lands in each split in proportion to its size
+  for record_counts in counts:
+    assert [round(count / 500) for count in record_counts] == [1, 2, 3]
@@ -0,0 +1,106 @@
+import argparse
+import csv
+import json
+import nltk
+import os
+import pytest
+import sqlite3
+from .. import gml_csv_2_spider_schema_json as gml
+
+GML = [
+  {'Table': 'Singer', 'Column': 'Singer ID', 'Type': 'INTEGER', 'Primary Key': 'yes', 'Description': 'id', 'Joinable to': ''},
+  {'Table': 'Singer', 'Column': 'Name', 'Type': 'STRING', 'Primary Key': '', 'Description': 'name', 'Joinable to': ''},
+  {'Table': 'Concert', 'Column': 'Concert ID', 'Type': 'INTEGER', 'Primary Key': 'yes', 'Description': 'id', 'Joinable to': ''},
+  {'Table': 'Concert', 'Column': 'Singer ID', 'Type': 'INTEGER', 'Primary Key': '', 'Description': 'singer',
+   'Joinable to': 'Singer.Singer ID'},
+  {'Table': 'Concert', 'Column': 'Year', 'Type': 'date', 'Primary Key': '', 'Description': 'year', 'Joinable to': ''},
+]
+
+def write_gml(path, rows):
+  with open(path, 'w', newline='') as f:
+    writer = csv.DictWriter(f, fieldnames=list(GML[0]))
+    writer.writeheader()
+    writer.writerows(rows)
+
+def test_process_build_manifest(tmp_path, capsys):
+  gml_csv_file = tmp_path / 'gml.csv'
+  write_gml(gml_csv_file, GML)
+  args = argparse.Namespace(db_id='concert_singer', gml_csv_file=str(gml_csv_file), output_directory=str(tmp_path),
+                            build_manifest=str(tmp_path / 'build.json'))
+  gml.process(args)
+  assert "Verified DB contents" in capsys.readouterr().out
+  with open(tmp_path / 'concert_singer_schema_tables.json') as f:
+    tables_json = json.load(f)[0]
+  assert tables_json['table_names_original'] == ['singer', 'concert']
+  assert tables_json['foreign_keys'] == [[1, 4]]
+
+  # nothing is generated again while the GML is unchanged
+  sqlite_mtime = os.stat(tmp_path / 'concert_singer.sqlite').st_mtime_ns
+  gml.process(args)
+  out = capsys.readouterr().out
+  assert out.count("Up to date") == 2 and "Writing" not in out
+  assert os.stat(tmp_path / 'concert_singer.sqlite').st_mtime_ns == sqlite_mtime
+
+  # a description only changes the schema json, so the database is kept
+  write_gml(gml_csv_file, GML[:-1] + [dict(GML[-1], Description='year held')])
+  gml.process(args)
+  out = capsys.readouterr().out
+  assert "Writing Spider schema json file" in out and "Up to date:                      " + str(tmp_path / 'concert_singer.sqlite') in out
+
+def test_process_loads_rows(tmp_path, capsys):
+  gml_csv_file = tmp_path / 'gml.csv'
+  write_gml(gml_csv_file, GML)
+  sample_directory = tmp_path / 'samples'
+  sample_directory.mkdir()
+  (sample_directory / 'singer.csv').write_text("singer_id,name\n1,Joe\n2,\n")
+  args = argparse.Namespace(db_id='concert_singer', gml_csv_file=str(gml_csv_file), output_directory=str(tmp_path),
+                            sample_data_directory=str(sample_directory), synthetic_rows=3)
+  gml.process(args)
+  assert "Verified DB contents" in capsys.readouterr().out
+
+  conn = sqlite3.connect(tmp_path / 'concert_singer.sqlite')
+  assert conn.execute("SELECT singer_id, name FROM singer").fetchall() == [(1, 'Joe'), (2, None)]
+  assert conn.execute("SELECT concert_id, singer_id, year FROM concert").fetchall() == [
+    (1, 1, '2000-01-01'), (2, 2, '2000-01-02'), (3, 3, '2000-01-03')]
+  # synthetic foreign keys join with the referenced rows
+  assert conn.execute("SELECT T1.name FROM singer AS T1 JOIN concert AS T2 ON T1.singer_id = T2.singer_id").fetchall() == [
+    ('Joe',), (None,)]
+  conn.close()
+
+def test_create_schema_json_interleaved_tables():
+  schema_dict, col_index_dict = gml.create_schema_json(GML)
+  # rows of a table need not be next to each other
+  interleaved = [GML[2], GML[0], GML[3], GML[1], GML[4]]
+  interleaved_dict, interleaved_index = gml.create_schema_json(interleaved)
+  assert list(interleaved_dict) == ['concert', 'singer']
+  assert interleaved_dict == schema_dict
+  assert {column: list(columns) for column, columns in interleaved_dict.items()} == {
+    'concert': ['concert_id', 'singer_id', 'year'], 'singer': ['singer_id', 'name']}
+  # columns are numbered as in the tables json, whatever the row order
+  assert interleaved_index['singer.name'] == 5 and col_index_dict['singer.name'] == 2
+
+def test_foreign_keys_interleaved_tables():
+  rows = [
+    {'Table': 'a', 'Column': 'id', 'Type': 'INTEGER', 'Primary Key': 'yes', 'Description': '', 'Joinable to': ''},
+    {'Table': 'b', 'Column': 'id', 'Type': 'INTEGER', 'Primary Key': 'yes', 'Description': '', 'Joinable to': ''},
+    {'Table': 'b', 'Column': 'a_id', 'Type': 'INTEGER', 'Primary Key': '', 'Description': '', 'Joinable to': 'a.id'},
+    {'Table': 'a', 'Column': 'x', 'Type': 'STRING', 'Primary Key': '', 'Description': '', 'Joinable to': ''},
+  ]
+  schema_dict, col_index_dict = gml.create_schema_json(rows)
+  tables_json = gml.get_spider_table(schema_dict, 'ab')
+  assert tables_json['column_names_original'] == [[-1, '*'], [0, 'id'], [0, 'x'], [1, 'id'], [1, 'a_id']]
+  assert gml.define_foreign_keys(schema_dict, col_index_dict) == [[1, 4]]
+
+def test_define_foreign_keys_dedup():
+  # both sides of a join give the same foreign key
+  rows = GML[:1] + [dict(GML[1]), dict(GML[3], **{'Joinable to': 'Singer.Singer ID\nSinger.Name'})] + GML[2:3] + GML[4:]
+  rows[0] = dict(rows[0], **{'Joinable to': 'Concert.Singer ID'})
+  schema_dict, col_index_dict = gml.create_schema_json(rows)
+  assert gml.define_foreign_keys(schema_dict, col_index_dict) == [[1, 3], [2, 3]]
+
+@pytest.mark.parametrize('name', ['singer_id', 'Concert-Name', 'first name_2', 'año (est.)', 'x__y', '-lead', ''])
+def test_clean_column_table_name_matches_nltk(name):
+  tokenizer = nltk.tokenize.RegexpTokenizer(r'\w+')
+  expected = ' '.join(tokenizer.tokenize(name)).lower().replace('_', ' ').replace('-', ' ')
+  assert gml.clean_column_table_name(name) == expected
+  assert gml.clean_column_table_names([name, 'Singer ID', name]) == [expected, 'singer id', expected]
@@ -0,0 +1,126 @@
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from ..benchmark_process_sql import SPIDER_QUERIES, nltk_tokenize
+from ..process_sql import (
+  ParseCache, Schema, SqlParser, get_tables_with_alias, parse_sql, schema_fingerprint, tokenize, tokenize_with_offsets)
+
+@pytest.mark.parametrize('query', SPIDER_QUERIES)
+def test_tokenize_matches_nltk(query):
+  assert tokenize(query) == nltk_tokenize(query)
+
+@pytest.mark.parametrize('query', [
+  "a,b a,1 ,,x x,,1 :,b 1:2",
+  "x = 'v'. y",
+  "SELECT a FROM t WHERE b = 'c'.",
+  "a...b c..d e---f ```g``",
+  "cannot gonna x.wanna wanna(1) lemmein",
+  "SELECT a FROM t WHERE b='c' AND d=\"e\"f",
+  "“quoted” a–b a—b",
+])
+def test_tokenize_matches_nltk_quirks(query):
+  assert tokenize(query) == nltk_tokenize(query)
+
+def test_tokenize_unbalanced_quote():
+  with pytest.raises(AssertionError):
+    tokenize("SELECT a FROM t WHERE b = 'c")
+
+def test_tokenize_offsets():
+  query = "SELECT T1.name FROM t AS T1 WHERE name != 'Hey Jude' AND x >= 2"
+  toks = tokenize_with_offsets(query)
+  assert [tok for tok, _, _ in toks] == tokenize(query)
+  assert [query[start:end] for _, start, end in toks] == [
+    'SELECT', 'T1.name', 'FROM', 't', 'AS', 'T1', 'WHERE', 'name', '!=', "'Hey Jude'", 'AND', 'x', '>=', '2']
+
+  query = "SELECT a FROM t WHERE b = '\"c\"'"
+  tok, start, end = tokenize_with_offsets(query)[-1]
+  assert tok == query[start:end] == '"c"'
+
+SINGER_SCHEMA = Schema({
+  'singer': ['singer_id', 'name', 'country', 'age'],
+  'concert': ['concert_id', 'singer_id', 'year'],
+})
+
+def test_get_sql_with_entities():
+  parser = SqlParser(SINGER_SCHEMA)
+  query = "SELECT T1.name FROM singer AS T1 JOIN concert AS T2 ON T1.singer_id = T2.singer_id " \
+    "WHERE age > (SELECT avg(age) FROM singer)"
+  sql, mapped_entities = parser.get_sql_with_entities(query)
+  assert sql == parser.get_sql(query)
+  assert sorted(mapped_entities) == [
+    (1, 'singer@name'), (11, 'singer@singer_id'), (13, 'concert@singer_id'), (15, 'singer@age'),
+    (21, 'singer@age')]
+
+  toks = tokenize(query)
+  _, legacy_sql, legacy_entities = parse_sql(
+    toks, 0, get_tables_with_alias(SINGER_SCHEMA.schema, toks), SINGER_SCHEMA, mapped_entities_fn=list)
+  assert legacy_sql == sql and legacy_entities == mapped_entities
+
+def test_sql_parser_shared_between_threads():
+  parser = SqlParser(SINGER_SCHEMA)
+  queries = [
+    "SELECT name FROM singer WHERE age > {}".format(age) for age in range(50)] + [
+    "SELECT T2.year FROM singer AS T1 JOIN concert AS T2 ON T1.singer_id = T2.singer_id WHERE T1.name = '{}'".format(age)
+    for age in range(50)]
+  expected = [parser.get_sql_with_entities(query) for query in queries]
+  with ThreadPoolExecutor(8) as pool:
+    assert list(pool.map(parser.get_sql_with_entities, queries * 4)) == expected * 4
+
+def test_sql_parser_cache(tmp_path):
+  cache_file = str(tmp_path / 'parsed.db')
+  query = "SELECT name FROM singer WHERE age > (SELECT avg(age) FROM singer)"
+  expected = SqlParser(SINGER_SCHEMA).get_sql(query)
+
+  cache = ParseCache(max_size=1, db_path=cache_file)
+  parser = SqlParser(SINGER_SCHEMA, cache)
+  assert parser.get_sql(query) == expected
+  assert parser.get_sql(query) is parser.get_sql(query)
+  parser.get_sql("SELECT name FROM singer")
+  assert cache.stats == {'cache_misses': 2, 'cache_hits': 2, 'cache_evictions': 1}
+  cache.close()
+
+  # a later run reuses the stored result, with tuples intact
+  cache = ParseCache(db_path=cache_file)
+  assert SqlParser(SINGER_SCHEMA, cache).get_sql(query) == expected
+  assert cache.stats == {'cache_store_hits': 1}
+
+  # results are keyed by schema, so a changed schema parses again
+  other_schema = Schema(dict(SINGER_SCHEMA.schema, stadium=['stadium_id', 'name']))
+  assert schema_fingerprint(other_schema) != schema_fingerprint(SINGER_SCHEMA)
+  SqlParser(other_schema, cache).get_sql(query)
+  assert cache.stats['cache_misses'] == 1
+  cache.close()
+
+def test_sql_parser_parse_many():
+  parser = SqlParser(SINGER_SCHEMA)
+  queries = ["SELECT name FROM singer WHERE age > {}".format(age) for age in range(10)] + [
+    "SELECT nope FROM singer",
+    "SELECT name FROM singer WHERE name = 'x",
+    "SELECT T2.year FROM singer AS T1 JOIN concert AS T2 ON T1.singer_id = T2.singer_id",
+  ]
+  results = list(parser.parse_many(queries))
+  assert results == list(parser.parse_many(queries, workers=2, chunksize=2))
+  assert [query for query, _, _ in results] == queries
+  assert [sql for _, sql, _ in results[:10]] == [parser.get_sql(query) for query in queries[:10]]
+  assert results[10] == (queries[10], None, "AssertionError: Error col: nope")
+  assert results[11] == (queries[11], None, "AssertionError: Unexpected quote")
+  assert results[12][1] is not None and results[12][2] is None
+
+def test_parse_cache_file_shared_by_processes(tmp_path):
+  # a parser's unwritten results must not lock the file for the others
+  cache_file = str(tmp_path / 'parsed.db')
+  first, second = ParseCache(db_path=cache_file), ParseCache(db_path=cache_file)
+  first.db.execute("PRAGMA busy_timeout = 100")
+  second.db.execute("PRAGMA busy_timeout = 100")
+  first_sql = SqlParser(SINGER_SCHEMA, first).get_sql("SELECT name FROM singer")
+  second_sql = SqlParser(SINGER_SCHEMA, second).get_sql("SELECT age FROM singer")
+  second.flush()
+  first.flush()
+  second.close()
+  first.close()
+
+  cache = ParseCache(db_path=cache_file)
+  parser = SqlParser(SINGER_SCHEMA, cache)
+  assert parser.get_sql("SELECT name FROM singer") == first_sql
+  assert parser.get_sql("SELECT age FROM singer") == second_sql
+  assert cache.stats == {'cache_store_hits': 2}
+  cache.close()
@@ -0,0 +1,43 @@
+import json
+import pytest
+from ..benchmark_process_sql import NESTED_QUERIES, SPIDER_SCHEMA
+from ..process_sql import Schema, get_sql
+from ..spider_ir import ColumnTable, CompactSql, SpiderJsonWriter
+
+SCHEMA = Schema(SPIDER_SCHEMA)
+
+@pytest.mark.parametrize('query', NESTED_QUERIES)
+def test_compact_sql_round_trip(query):
+  sql = get_sql(SCHEMA, query)
+  compact = CompactSql.from_spider(sql, ColumnTable())
+  assert compact.to_spider() == sql
+  assert list(compact.to_spider()) == list(sql)
+
+def test_compact_sql_from_spider_json():
+  columns = ColumnTable()
+  for query in NESTED_QUERIES:
+    sql = get_sql(SCHEMA, query)
+    loaded = json.loads(json.dumps(sql))
+    compact = CompactSql.from_spider(loaded, columns)
+    assert json.dumps(compact.to_spider()) == json.dumps(sql)
+  # columns are shared between queries of a schema
+  assert len(columns.ids) < sum(len(cols) for cols in SPIDER_SCHEMA.values()) + len(SPIDER_SCHEMA) + 1
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_spider_json_writer(tmp_path, compact):
+  columns = ColumnTable()
+  queries = [{'query': query, 'sql': get_sql(SCHEMA, query)} for query in NESTED_QUERIES]
+  output_file = tmp_path / 'out.json'
+  with SpiderJsonWriter(output_file, compact) as writer:
+    for query in queries:
+      writer.write(dict(query, sql=CompactSql.from_spider(query['sql'], columns)))
+
+  if compact:
+    assert json.loads(output_file.read_text()) == json.loads(json.dumps(queries))
+  else:
+    assert output_file.read_text() == json.dumps(queries, sort_keys=True, indent=2, separators=(',', ': '))
+
+def test_spider_json_writer_empty(tmp_path):
+  output_file = tmp_path / 'out.json'
+  SpiderJsonWriter(output_file).close()
+  assert output_file.read_text() == json.dumps([], sort_keys=True, indent=2)
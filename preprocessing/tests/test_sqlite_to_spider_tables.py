@@ -0,0 +1,56 @@
+import json
+import pytest
+import sqlite3
+from .. import sqlite_to_spider_tables
+
+SQL = """
+CREATE TABLE singer (singer_id INTEGER PRIMARY KEY, Name VARCHAR(255), Is_Male bool, Birth_Date DATETIME);
+CREATE TABLE concert (concert_id int, singer_id int, year NUMERIC(4), PRIMARY KEY (concert_id),
+  FOREIGN KEY (singer_id) REFERENCES Singer(Singer_ID));
+CREATE TABLE "singer in concert" (concert_id int REFERENCES concert, singer_id int, note,
+  FOREIGN KEY (singer_id) REFERENCES singer (singer_id), FOREIGN KEY (singer_id) REFERENCES singer (singer_id));
+"""
+
+def create_db(path, sql=SQL):
+  conn = sqlite3.connect(path)
+  conn.executescript(sql)
+  conn.close()
+  return str(path)
+
+def test_get_spider_tables(tmp_path):
+  sqlite_file = create_db(tmp_path / 'concert_singer.sqlite')
+  assert sqlite_to_spider_tables.get_spider_tables(sqlite_file) == {
+    "column_names": [[-1, "*"], [0, "singer id"], [0, "name"], [0, "is male"], [0, "birth date"], [1, "concert id"],
+                     [1, "singer id"], [1, "year"], [2, "concert id"], [2, "singer id"], [2, "note"]],
+    "column_names_original": [[-1, "*"], [0, "singer_id"], [0, "Name"], [0, "Is_Male"], [0, "Birth_Date"],
+                              [1, "concert_id"], [1, "singer_id"], [1, "year"], [2, "concert_id"], [2, "singer_id"],
+                              [2, "note"]],
+    "column_types": ["text", "number", "text", "boolean", "time", "number", "number", "number", "number", "number", "text"],
+    "primary_keys": [1, 5],
+    "foreign_keys": [[6, 1], [9, 1], [8, 5]],
+    "table_names_original": ["singer", "concert", "singer in concert"],
+    "table_names": ["singer", "concert", "singer in concert"],
+    "db_id": "concert_singer",
+  }
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_sqlite_to_spider_tables_cache(tmp_path, capsys, workers):
+  database = tmp_path / 'database'
+  for db_id in ('b', 'a', 'c'):
+    (database / db_id).mkdir(parents=True)
+    create_db(database / db_id / f'{db_id}.sqlite')
+  sqlite_files = sqlite_to_spider_tables.find_sqlite_files([str(database)])
+  cache_file = str(tmp_path / 'cache.json')
+
+  all_tables = sqlite_to_spider_tables.sqlite_to_spider_tables(sqlite_files, cache_file, workers)
+  assert [tables['db_id'] for tables in all_tables] == ['a', 'b', 'c']
+  assert "Read 3 databases, 0 from cache" in capsys.readouterr().out
+
+  # only the changed database is read again
+  create_db(database / 'b' / 'b.sqlite', "CREATE TABLE pets (pet_id int, weight real);")
+  changed = sqlite_to_spider_tables.sqlite_to_spider_tables(sqlite_files, cache_file, workers)
+  assert "Read 1 databases, 2 from cache" in capsys.readouterr().out
+  assert changed[0] == all_tables[0] and changed[2] == all_tables[2]
+  assert changed[1]['table_names_original'] == ['singer', 'concert', 'singer in concert', 'pets']
+  with open(cache_file) as f:
+    assert len(json.load(f)) == 3